@@ -0,0 +1,88 @@
+"""
+Compares the time needed to read an ang file using the single pass parser
+of pyebsd.load_ang_file and the former approach based on pandas.read_csv.
+
+The ang file data/ADI_bcc_fcc_cropped.ang is synthetically scaled up by
+stacking copies of its rows along the y direction.
+"""
+
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+import pandas as pd
+import pyebsd
+
+
+def load_ang_file_pandas(fname):
+    """
+    Former implementation of load_ang_file: header is read line by line,
+    then the whole file is read again by pandas.read_csv
+    """
+    with open(fname) as f:
+        header = []
+        for line in f:
+            if line[0] == '#' or line[0] == '\n':
+                header.append(line)
+            else:
+                break
+
+    data = pd.read_csv(fname, header=None, comment='#', delim_whitespace=True)
+    columns = list(data.columns)
+    columns[:10] = ['phi1', 'Phi', 'phi2', 'x', 'y', 'IQ', 'CI', 'ph', 'intensity', 'fit']
+    data.columns = columns
+    return data, header
+
+
+def scale_ang_file(fname, fname_out, ncopies):
+    """
+    Writes ang file 'fname_out' with ncopies of the rows of 'fname' stacked
+    along the y direction
+    """
+    scan = pyebsd.load_ang_file(fname)
+
+    # An even number of rows is used so odd and even rows keep alternating
+    nrows = scan.nrows - scan.nrows % 2
+    sel = scan.i < nrows
+    data = scan.data[sel]
+
+    header = []
+    for line in scan.header:
+        if '# NROWS:' in line:
+            line = '# NROWS: {:d}\n'.format(nrows*ncopies)
+        header.append(line)
+
+    fmt = ' '.join(['%d' if data[col].dtype.kind == 'i' else '%.5f' for col in data.columns])
+
+    with open(fname_out, 'w') as f:
+        f.write(''.join(header))
+        for n in range(ncopies):
+            chunk = data.values.copy()
+            chunk[:, 4] += n*nrows*scan.dy
+            np.savetxt(f, chunk, fmt=fmt)
+
+
+if __name__ == '__main__':
+    ncopies = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    fname = os.path.join('..', 'data', 'ADI_bcc_fcc_cropped.ang')
+
+    tmpdir = tempfile.mkdtemp()
+    fname_scaled = os.path.join(tmpdir, 'scaled.ang')
+    scale_ang_file(fname, fname_scaled, ncopies)
+    print('Size of the scaled file: {:.1f} MB'.format(os.path.getsize(fname_scaled)/2.**20))
+
+    t0 = time.time()
+    data, header = load_ang_file_pandas(fname_scaled)
+    t_pandas = time.time() - t0
+
+    t0 = time.time()
+    scan = pyebsd.load_ang_file(fname_scaled)
+    t_pyebsd = time.time() - t0
+
+    print('\n{} points'.format(scan.N))
+    print('pandas.read_csv: {:.2f} s'.format(t_pandas))
+    print('load_ang_file: {:.2f} s'.format(t_pyebsd))
+
+    os.remove(fname_scaled)
+    os.rmdir(tmpdir)
@@ -22,7 +22,7 @@ if __name__ == '__main__':
     variants['CP group'] = np.repeat(range(4), 6)
     variants['Bain group'] = -1
     for group in range(3):
-        misang = [pyebsd.misorientation(M_KS[j], M_KS[v]) for j in range(len(M_KS))]
+        misang = pyebsd.misorientation(M_KS, M_KS[v])
 
         if v == 0:
             variants['Rotation from variant 1 (deg)'] = misang
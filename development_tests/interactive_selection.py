@@ -51,7 +51,7 @@ while key != 'q':
     if np.count_nonzero(ipf.sel) > 0:
         M_fcc = pyebsd.average_orientation(scan.M,
                                            sel=ipf.sel & (scan.ph == 2) & (scan.CI > .2),
-                                           vectorized=False, verbose=True)  # , plot=True, n=10, maxdev=10., it=5)
+                                           verbose=True)  # , refine=True, plot=True, n=10, maxdev=10., it=5)
 
         # plot IPF of the selected data
         ax2.cla()  # clear axis
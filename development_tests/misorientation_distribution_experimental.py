@@ -5,11 +5,9 @@ import pyebsd
 
 
 def misorientation_between_variants(V):
-    mis = []
-    for i in range(len(V)):
-        for j in range(i + 1, len(V)):
-            mis.append(pyebsd.misorientation(V[i], V[j]))
-    return mis
+    # misorientations between all pairs (i, j) with i < j
+    mis = pyebsd.misorientation(V, V, pairwise=True)
+    return mis[np.triu_indices(len(V), k=1)]
 
 
 if __name__ == '__main__':
@@ -18,10 +16,8 @@ if __name__ == '__main__':
 
     sel = (scan.ph == 1) & (scan.CI > .2)
     
-    # First nearest neighbors
-    neighbors = scan.get_neighbors(1, sel=sel)
-    # Experimental misorientations
-    mis_exp = pyebsd.misorientation_neighbors(scan.M, neighbors, sel=sel).ravel()
+    # Experimental misorientations between first nearest neighbors
+    mis_exp = scan.get_misorientation_neighbors(1, sel=sel).ravel()
 
     # Expected misorientations between KS variants
     mis_calc = misorientation_between_variants(pyebsd.OR())  # for KS OR variants
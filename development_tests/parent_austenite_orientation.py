@@ -28,7 +28,7 @@ except:
     R_fcc = scan.R[sel_fcc]
     M_fcc = R_fcc.transpose([0, 2, 1])
     R_fcc_avg = pyebsd.average_orientation(R_fcc,
-                                           vectorized=False, verbose=True,
+                                           refine=True, verbose=True,
                                            n=10, maxdev=10., it=5)
     M_fcc_avg = R_fcc_avg.T
 
@@ -0,0 +1,74 @@
+"""
+Validates the closed-form cubic disorientation kernel used by
+pyebsd.misorientation_neighbors against the former implementation, which
+takes the maximum trace over the 24 cubic symmetry operators, and compares
+the time needed to calculate the KAM.
+"""
+
+import os
+import time
+import numpy as np
+import pyebsd
+from pyebsd.ebsd.orientation import _cubic_disorientation_w
+
+
+def misorientation_neighbors_24ops(M, neighbors, sel=None, out='deg'):
+    """
+    Former implementation of misorientation_neighbors using rotation
+    matrices and looping over the 24 cubic symmetry operators
+    """
+    N = M.shape[0]
+    nneighbors = neighbors.shape[1]
+
+    C = pyebsd.list_cubic_symmetry_operators()
+
+    tr = np.full((N, nneighbors), -2., dtype=float)
+    misang = np.full((N, nneighbors), -1., dtype=float)
+
+    if not isinstance(sel, np.ndarray):
+        sel = np.full(N, True, dtype=bool)
+
+    for k in range(nneighbors):
+        ok = (neighbors[:, k] >= 0) & sel & sel[neighbors[:, k]]
+        T = np.einsum('ijk,imk->ijm', M[neighbors[ok, k]], M[ok])
+
+        for m in range(len(C)):
+            a, b = C[m].nonzero()
+            ttr = np.einsum('j,ij->i', C[m, a, b], T[:, a, b])
+            tr[ok, k] = np.max(np.vstack([tr[ok, k], ttr]), axis=0)
+
+    tr[tr > 3.] = 3.
+    ok = tr >= -1.
+    misang[ok] = pyebsd.trace_to_angle(tr[ok], out)
+    return misang
+
+
+if __name__ == '__main__':
+    # Random misorientation quaternions: closed form vs 24 operators
+    dq = np.random.randn(100000, 4)
+    dq /= np.linalg.norm(dq, axis=1).reshape(-1, 1)
+    Cq = pyebsd.list_cubic_symmetry_quaternions()
+    w_24ops = np.abs(np.dot(dq, Cq.T)).max(axis=1)
+    w = _cubic_disorientation_w(dq)
+    print('Max. difference of w (random quaternions): {:g}'.format(np.abs(w - w_24ops).max()))
+    # Maximum disorientation angle for cubic symmetry is 62.8 deg
+    print('Max. disorientation angle: {:.2f} deg'.format(np.degrees(2.*np.arccos(w.min()))))
+
+    fname = os.path.join('..', 'data', 'ADI_bcc_fcc_cropped.ang')
+    scan = pyebsd.load_scandata(fname)
+
+    for distance in [1, 2, 3]:
+        neighbors = scan.get_neighbors(distance)
+
+        t0 = time.time()
+        mis_24ops = misorientation_neighbors_24ops(scan.M, neighbors)
+        t_24ops = time.time() - t0
+
+        t0 = time.time()
+        mis = pyebsd.misorientation_neighbors(scan.q, neighbors, verbose=False)
+        t_closed = time.time() - t0
+
+        print('\ndistance = {}'.format(distance))
+        print('Max. difference: {:g} deg'.format(np.abs(mis - mis_24ops).max()))
+        print('24 operators: {:.3f} s'.format(t_24ops))
+        print('closed form: {:.3f} s'.format(t_closed))
@@ -14,44 +14,21 @@ if __name__ == '__main__':
     selection = (scan.ph == 1)  # Selects phase indexed as 1
     indices, = np.where(selection)
 
-    distance = []  # real distance in (normally um) to n-th nearest neighbor
-    kam = []  # list with KAM values for every pixel for each distance
     convention, maxmis, nneighbors = 'OIM', 5., 5
     # convention, maxmis, nneighbors = 'fixed', 5., 15
 
-    for d in range(1, nneighbors + 1):
-        distance.append(scan.get_distance_neighbors(distance=d, distance_convention=convention))
-        kam.append(scan.get_KAM(distance=d, distance_convention=convention,
-                                sel=selection, maxmis=maxmis))
-
-    # Converts lists to numpy array
-    distance = np.array(distance)
-    kam = np.array(kam).T  # more convenient to work with the transposed array
+    # KAM values for every pixel for each distance (shape N x nneighbors),
+    # real distance (normally in um) to n-th nearest neighbor, and linear
+    # fit of KAM vs distance (slope m, intercept b, and R squared)
+    kam, distance, m, b, Rsquared = scan.get_KAM_profile(
+        distances=range(1, nneighbors + 1), distance_convention=convention,
+        sel=selection, maxmis=maxmis)
 
     # Average KAM values for each DISTANCE
     kamavg = np.nan_to_num(kam).mean(axis=0)  # nan values become 0 first
 
-    # Linear fit of KAM vs distance
-    # Slope m
-    m = (nneighbors*(kam*distance).sum(axis=1) - kam.sum(axis=1)*distance.sum())
-    m /= (nneighbors*(distance**2).sum() - (distance.sum())**2)
-    # Intercept b
-    b = kam.sum(axis=1) - m*distance.sum()
-    b /= nneighbors
-
     # Fitted KAM values
     kamfit = m.reshape(-1, 1)*distance + b.reshape(-1, 1)
-    # Standard deviation
-    sd = ((kam - kamfit)**2).sum(axis=1)
-    sd /= nneighbors
-    sd **= .5
-
-    kammean = kam.mean(axis=1).reshape(-1, 1)
-    SStot = ((kam - kammean)**2.).sum(axis=1)
-    SStot[SStot == 0.] = 1.
-    SSres = ((kam - kamfit)**2.).sum(axis=1)
-    # R squared
-    Rsquared = 1. - SSres/SStot
 
     fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(14, 6))
 
@@ -2,8 +2,7 @@ import sys
 import time
 import numpy as np
 
-from .orientation import (list_cubic_family_directions,
-                          list_cubic_symmetry_operators,
+from .orientation import (get_symmetry_operators,
                           reduce_cubic_transformations, average_orientation,
                           rotation_matrix_to_euler_angles,
                           euler_angles_to_rotation_matrix)
@@ -22,6 +21,13 @@ def OR_exp(M, ph, phdict=dict(parent=2, child=1), sel=None, **kwargs):
       and bainite by electron backscatter diffraction analysis. 
       Scripta Materialia, 60(12), 1113-1116.
       http://doi.org/10.1016/j.scriptamat.2009.02.053
+
+    The average orientation of the parent phase and the average OR
+    matrix are calculated by the eigenvector method (see
+    average_orientation), which can differ by a few degrees from the
+    results of previous versions. kwargs (e.g., refine=True, n, maxdev,
+    it) are passed to rotation_matrix_to_euler_angles to refine the
+    average OR matrix by minimize_disorientation
     """
     t0 = time.time()
     verbose = kwargs.pop('verbose', True)
@@ -46,7 +52,7 @@ def OR_exp(M, ph, phdict=dict(parent=2, child=1), sel=None, **kwargs):
     N = len(M_chd)
 
     # Get symmetry matrices
-    C = list_cubic_symmetry_operators()
+    C = get_symmetry_operators('cubic', 'matrix', float)
     # T : ndarray shape(24, 3, 3)
     T = np.tensordot(C, M_prt, axes=[[-1], [-2]]).transpose([0, 2, 1])
     # U : ndarray shape(N, 24, 3, 3)
@@ -106,7 +112,7 @@ def OR(ps=([1, 1, 1], [0, 1, 1]), ds=([0, 1, 1], [1, 1, 1]), **kwargs):
     p_prt, d_prt = ps[0], ds[0]  # parent phase
     p_chd, d_chd = ps[1], ds[1]  # child phase
 
-    C = list_cubic_symmetry_operators()
+    C = get_symmetry_operators('cubic', 'matrix')
 
     # check variants normal to plane 'n'. Due to numerical truncation,
     # instead of choosing the variants 'd' based on np.dot(d,n) == 0,
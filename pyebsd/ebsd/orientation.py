@@ -1,5 +1,7 @@
+import os
 import sys
 import time
+import warnings
 import numpy as np
 
 __all__ = ['trace_to_angle', 'stereographic_projection',
@@ -7,8 +9,12 @@ __all__ = ['trace_to_angle', 'stereographic_projection',
            'misorientation', 'misorientation_neighbors',
            'kernel_average_misorientation', 'minimize_disorientation',
            'euler_angles_to_rotation_matrix', 'rotation_matrix_to_euler_angles',
-           'axis_angle_to_rotation_matrix', 'list_cubic_symmetry_operators_KS',
-           'list_cubic_symmetry_operators', 'list_cubic_family_directions',
+           'axis_angle_to_rotation_matrix', 'quaternion_product',
+           'rotation_matrix_to_quaternion', 'quaternion_to_rotation_matrix',
+           'euler_angles_to_quaternion', 'quaternion_to_euler_angles',
+           'get_symmetry_operators', 'list_cubic_symmetry_operators_KS',
+           'list_cubic_symmetry_operators', 'list_cubic_symmetry_quaternions',
+           'list_cubic_family_directions',
            'reduce_cubic_transformations', 'IPF', 'PF']
 
 
@@ -103,11 +109,19 @@ def stereographic_projection_to_direction(xy):
 
 def average_orientation(M, sel=None, **kwargs):
     """
-    Calculates rotation matrix corresponding to average orientation
-
-    M : numpy ndarray shape(N, 3, 3)
-        List of rotation matrices describing the rotation from the sample 
-        coordinate frame to the crystal coordinate frame
+    Calculates rotation matrix corresponding to average orientation.
+    The orientations are reduced to the symmetrically equivalent ones
+    closest to a reference orientation, then averaged by the eigenvector
+    method [1], which takes O(N) time and memory. The average is
+    calculated twice, the first time using the orientation in the middle
+    of the list as reference, the second time using the first average.
+
+    [1] F. L. Markley, Y. Cheng, J. L. Crassidis, Y. Oshman, J. Guid.
+        Control Dyn. 30 (2007) 1193-1197.
+
+    M : numpy ndarray shape(N, 3, 3) or shape(N, 4)
+        List of rotation matrices (or quaternions) describing the rotation
+        from the sample coordinate frame to the crystal coordinate frame
     sel : bool numpy 1D array (optional)
         Boolean array indicating data points calculations should be 
         performed
@@ -116,123 +130,531 @@ def average_orientation(M, sel=None, **kwargs):
         verbose : bool (optional)
             If True, prints computation time
             Default: True
-        vectorized : bool (optional)
-            If True, performs all operations vectorized using numpy
-            Default: True
+        chunksize : int (optional)
+            Number of orientations processed at once. The orientations
+            are streamed in chunks and only the 4x4 matrix of the
+            eigenvector method is accumulated, so the memory used does
+            not depend on the size of the selection
+            Default: 65536
+        refine : bool (optional)
+            If True, the average orientation is refined by a grid search
+            of the orientation that minimizes the disorientation (see
+            minimize_disorientation, to which the remaining kwargs are
+            passed). The refinement requires the rotation matrices of
+            all the selected orientations. If None, the refinement is
+            enabled when any of the options of minimize_disorientation
+            (n, maxdev, it, plot) is provided, as in previous versions,
+            and a DeprecationWarning is issued
+            Default: None
 
     Returns
     -------
-    M_avg : numpy ndarray shape(3, 3)
-        Average orientation matrix
+    M_avg : numpy ndarray shape(3, 3) or shape(4)
+        Average orientation matrix (or quaternion, if M is provided as
+        quaternions)
+
+    Notes
+    -----
+    Previous versions always averaged the matrix elements and refined the
+    result by minimize_disorientation. For selections spanning several
+    grains or wide orientation spreads, the eigenvector average can differ
+    from the former result by a few degrees. Use refine=True to refine it
+    by the former grid search. The option 'vectorized' of the former
+    engine is deprecated and has no effect
     """
-    # verbose is pased to 'rotation_matrix_to_euler_angles', so use kwargs.get, not kwargs.pop
-    verbose = kwargs.get('verbose', True)
+    verbose = kwargs.pop('verbose', True)
+    refine = _pop_refine(kwargs, 'average_orientation')
     if verbose:
         t0 = time.time()
         sys.stdout.write('Calculating average orientation... ')
         sys.stdout.flush()
 
-    if isinstance(sel, np.ndarray):
-        M_sel = M[sel]
-    else:
-        M_sel = M
-
-    N = len(M_sel)
-    MrefT = M_sel[N//2].T
-    C = list_cubic_symmetry_operators()
-
-    # 'vectorized' is passed to rotation_matrix_to_euler_angles, which in turn is passed
-    # to minimize_disorientation. That's why I'm using kwargs.get instead of kwargs.pop
-    if kwargs.get('vectorized', True):
-        # 4 dimensional numpy narray(N,24,3,3)
-        Mprime = np.tensordot(C, M_sel,
-                              axes=[[-1], [-2]]).transpose([2, 0, 1, 3])
-        # misorientation matrices D
-        D = np.tensordot(Mprime, MrefT, axes=[[-1], [-2]])
-        tr = np.trace(D, axis1=2, axis2=3)
-        neg = tr < -1.
-        tr[neg] = -tr[neg]
-        Mprime[neg] = -Mprime[neg]
-        M_sel = Mprime[(list(range(N)), np.argmax(tr, axis=1))]
-    else:
-        for i in range(N):
-            Mprime = np.tensordot(C, M_sel[i], axes=[[-1], [-2]])
-            D = np.tensordot(Mprime, MrefT, axes=[[-1], [-2]])
-            tr = np.trace(D, axis1=1, axis2=2)
-            neg = tr < 0.  # select negative traces
-            tr[neg] = -tr[neg]
-            Mprime[neg] = -Mprime[neg]
-            M_sel[i] = Mprime[np.argmax(tr)]
+    chunksize = kwargs.pop('chunksize', None)
+    if chunksize is None:
+        chunksize = _labels_blocksize
 
-    R_sel = M_sel.transpose([0, 2, 1])
-    phi1, Phi, phi2 = rotation_matrix_to_euler_angles(R_sel, avg=True, **kwargs)
-
-    M_avg = euler_angles_to_rotation_matrix(phi1, Phi, phi2, verbose=False).T
+    if not isinstance(sel, np.ndarray):
+        sel = None
+
+    N = len(M) if sel is None else np.count_nonzero(sel)
+    if N == 0:
+        raise Exception('average_orientation: no orientation selected')
+    quaternion = _is_quaternion(M)
+
+    # The average orientation is calculated using quaternions. The
+    # reference orientation is first the one in the middle of the
+    # selection, then the first average
+    q_avg = _as_quaternions(M[_selected_index(sel, N//2, chunksize)])[0][0]
+    for i in range(2):
+        A = np.zeros((4, 4))
+        for q in _iter_quaternion_chunks(M, sel, chunksize):
+            q_sel = _align_quaternions(q, q_avg)
+            A += np.dot(q_sel.T, q_sel)
+        q_avg = _eigen_quaternion_mean(A)
+    del q, q_sel
+
+    if refine:
+        # R = M^T, i.e., the conjugate quaternion
+        R_sel = np.vstack([quaternion_to_rotation_matrix(
+            _quaternion_conjugate(_align_quaternions(q, q_avg)))
+            for q in _iter_quaternion_chunks(M, sel, chunksize)])
+        R_avg = quaternion_to_rotation_matrix(_quaternion_conjugate(q_avg))
+        R_avg = minimize_disorientation(R_sel, R_avg, **kwargs)
+        q_avg = _quaternion_positive(_quaternion_conjugate(rotation_matrix_to_quaternion(R_avg)))
+        del R_sel
+
+    if quaternion:
+        M_avg = q_avg
+    else:
+        M_avg = quaternion_to_rotation_matrix(q_avg)
 
     if verbose:
         sys.stdout.write('{:.2f} s\n'.format(time.time() - t0))
         sys.stdout.flush()
 
-    del D, Mprime, M_sel, R_sel
     return M_avg
 
 
-def misorientation(A, B, out='deg'):
+# Number of orientations processed at once by average_orientation and by
+# the segmented (per label) reductions of orientations
+_labels_blocksize = 2**16
+
+# Options of minimize_disorientation, which enabled the grid search
+# refinement of the average orientation in previous versions
+_refine_kwargs = ['n', 'maxdev', 'it', 'plot']
+
+
+def _pop_refine(kwargs, caller):
+    """
+    Pops the option 'refine' from kwargs. If refine is not provided,
+    the refinement is enabled when any of the options of
+    minimize_disorientation is provided, with a DeprecationWarning.
+    Options of the former averaging engine are removed from kwargs
+    """
+    if kwargs.pop('vectorized', None) is not None:
+        warnings.warn('{}: option "vectorized" is deprecated and has no effect'.format(caller),
+                      DeprecationWarning, stacklevel=3)
+
+    refine = kwargs.pop('refine', None)
+    legacy = [key for key in _refine_kwargs if key in kwargs]
+    if refine is None:
+        refine = len(legacy) > 0
+        if refine:
+            warnings.warn(('{}: {} provided without refine. The average orientation is '
+                           'refined by minimize_disorientation, as in previous versions. '
+                           'Pass refine=True explicitly').format(caller, ', '.join(legacy)),
+                          DeprecationWarning, stacklevel=3)
+    elif not refine and len(legacy) > 0:
+        warnings.warn(('{}: {} ignored, since refine=False').format(caller, ', '.join(legacy)),
+                      stacklevel=3)
+        for key in legacy:
+            kwargs.pop(key)
+
+    return refine
+
+
+def _selected_index(sel, k, chunksize):
+    """
+    Index of the k-th True element of sel (of k if sel is None), found
+    by scanning sel in chunks
+    """
+    if sel is None:
+        return k
+    for start in range(0, len(sel), chunksize):
+        nsel = np.count_nonzero(sel[start:start+chunksize])
+        if k < nsel:
+            return start + np.flatnonzero(sel[start:start+chunksize])[k]
+        k -= nsel
+    raise Exception('Less than {} elements selected'.format(k + 1))
+
+
+def _iter_quaternion_chunks(M, sel, chunksize):
+    """
+    Yields the quaternions of the selected orientations M (rotation
+    matrices or quaternions) in chunks of chunksize orientations of M
+    """
+    for start in range(0, len(M), chunksize):
+        M_chunk = np.asarray(M[start:start+chunksize])
+        if sel is not None:
+            M_chunk = M_chunk[sel[start:start+chunksize]]
+        if len(M_chunk) > 0:
+            yield M_chunk if _is_quaternion(M_chunk) else rotation_matrix_to_quaternion(M_chunk)
+
+
+def _align_quaternions(q, qref):
+    """
+    Quaternions equivalent to q by the cubic symmetry closest to the
+    reference quaternions qref, such as <q_sel, qref> >= 0. q and qref
+    are numpy ndarrays shape(N, 4)
+    """
+    N = len(q)
+    Cq = get_symmetry_operators('cubic', 'quaternion')
+    # |<c_m*q_i, qref_i>| is the cosine of half the misorientation angle.
+    # It is the scalar part of c_m*dq_i, with dq_i = q_i*conj(qref_i), so
+    # the equivalent quaternions c_m*q_i do not need to be calculated
+    dq = quaternion_product(q, _quaternion_conjugate(qref))
+    dot = np.dot(dq, _quaternion_conjugate(Cq).T)
+    del dq
+    imax = np.argmax(np.abs(dot), axis=1)
+    q_sel = quaternion_product(Cq[imax], q)
+    # q and -q describe the same rotation
+    q_sel[dot[np.arange(N), imax] < 0.] *= -1.
+    return q_sel
+
+
+def _eigen_quaternion_mean(A):
+    """
+    Average quaternion(s) given by the eigenvector with the largest
+    eigenvalue of the 4x4 matrix A = sum(q q^T) [1]. A can also be a
+    numpy ndarray shape(N, 4, 4)
+
+    [1] F. L. Markley, Y. Cheng, J. L. Crassidis, Y. Oshman, J. Guid.
+        Control Dyn. 30 (2007) 1193-1197.
+    """
+    _, v = np.linalg.eigh(A)  # eigenvalues in ascending order
+    return _quaternion_positive(v[..., -1])
+
+
+def _average_quaternions_labels(q, labels, nlabels, qref, blocksize=None):
+    """
+    Average orientations (as quaternions) of the data points of each
+    label (0 to nlabels - 1). The quaternions q are aligned to the
+    reference quaternions qref shape(nlabels, 4) of their labels, then
+    the average orientation is calculated by the eigenvector method (see
+    _eigen_quaternion_mean). The data points are processed in blocks and
+    only the 4x4 matrices of each label are accumulated. Data points
+    with negative labels are ignored
+    """
+    if blocksize is None:
+        blocksize = _labels_blocksize
+
+    A = np.zeros((nlabels, 4, 4))
+    for start in range(0, len(q), blocksize):
+        lab = labels[start:start+blocksize]
+        ok = lab >= 0
+        lab = lab[ok]
+        q_sel = _align_quaternions(np.asarray(q[start:start+blocksize])[ok], qref[lab])
+        for a in range(4):
+            for b in range(a, 4):
+                A[:, a, b] += np.bincount(lab, weights=q_sel[:, a]*q_sel[:, b],
+                                          minlength=nlabels)
+    for a in range(4):
+        for b in range(a):
+            A[:, a, b] = A[:, b, a]
+
+    return _eigen_quaternion_mean(A)
+
+
+def _sum_misorientation_labels(q, labels, nlabels, qref, out='deg', blocksize=None):
+    """
+    Sum of the misorientation angles between the data points q of each
+    label (0 to nlabels - 1) and the reference quaternions qref
+    shape(nlabels, 4) of their labels. Data points with negative labels
+    are ignored
+    """
+    if blocksize is None:
+        blocksize = _labels_blocksize
+
+    misang_sum = np.zeros(nlabels)
+    for start in range(0, len(q), blocksize):
+        lab = labels[start:start+blocksize]
+        ok = lab >= 0
+        lab = lab[ok]
+        dq = quaternion_product(np.asarray(q[start:start+blocksize])[ok],
+                                _quaternion_conjugate(qref[lab]))
+        misang = _w_to_misorientation(_cubic_disorientation_w(dq), out)
+        misang_sum += np.bincount(lab, weights=misang, minlength=nlabels)
+
+    return misang_sum
+
+
+def _cubic_disorientation_w(dq, axis=-1):
     """
-    Calculates the misorientation between A e B
+    Largest scalar part |w| among the quaternions equivalent to the
+    misorientation quaternions dq by the cubic symmetry, i.e., the cosine
+    of half of the disorientation angle. Closed form of
+
+        np.abs(np.dot(dq, list_cubic_symmetry_quaternions().T)).max(axis=-1)
+
+    Being a >= b >= c >= d the absolute values of the components of dq:
+
+        w = max(a, (a + b)/sqrt(2), (a + b + c + d)/2)
 
     Parameters
     ----------
-    A : numpy ndarray shape(3, 3)
-        First rotation matrix
-    B : numpy ndarray shape(3, 3)
-        Second rotation matrix
+    dq : numpy ndarray shape(4) or shape(N, 4)
+        Misorientation quaternions
+    axis : int (optional)
+        Axis of dq along which the quaternion components are stored
+        Default: -1
+
+    Returns
+    -------
+    w : float or numpy ndarray shape(N)
+    """
+    single = np.ndim(dq) == 1
+    a = np.abs(dq).reshape(1, 4) if single else np.abs(dq)
+    a0, a1, a2, a3 = np.moveaxis(a, axis, 0)
+    # a: largest component
+    w = np.maximum(a0, a1)
+    np.maximum(w, a2, out=w)
+    np.maximum(w, a3, out=w)
+    # a + b: largest sum of two components
+    s01, s23 = a0 + a1, a2 + a3
+    pairs = np.maximum(s01, s23)
+    s = a0 + a2
+    np.maximum(pairs, s, out=pairs)
+    np.add(a1, a3, out=s)
+    np.maximum(pairs, s, out=pairs)
+    np.add(a0, a3, out=s)
+    np.maximum(pairs, s, out=pairs)
+    np.add(a1, a2, out=s)
+    np.maximum(pairs, s, out=pairs)
+    pairs /= 2.**.5
+    np.maximum(w, pairs, out=w)
+    # (a + b + c + d)/2
+    s01 += s23
+    s01 /= 2.
+    np.maximum(w, s01, out=w)
+    return w[0] if single else w
+
+
+# Maximum number of pairs of orientations processed at once by misorientation
+_misorientation_blocksize = 2**16
+
+
+def _as_quaternions(A):
+    """
+    Converts A (rotation matrix or quaternion, single or list) to a 2D
+    array of quaternions shape(N, 4). Returns also whether A is a single
+    orientation
+    """
+    A = np.asarray(A, dtype=float)
+    if A.shape[-2:] == (3, 3) and A.ndim in (2, 3):
+        return rotation_matrix_to_quaternion(A.reshape(-1, 3, 3)), A.ndim == 2
+    if A.shape[-1:] == (4,) and A.ndim in (1, 2):
+        return A.reshape(-1, 4), A.ndim == 1
+    raise Exception('Invalid shapes of arrays A or B')
+
+
+def _w_to_misorientation(w, out='deg'):
+    """
+    Converts (in place) the scalar parts w of misorientation quaternions
+    to the trace of the misorientation matrix (out='tr') or to the
+    misorientation angle (out='deg' or 'rad')
+    """
+    x = w
+    # trace = 4w^2 - 1
+    x *= x
+    x *= 4.
+    x -= 1.
+    # This might happen due to rounding error
+    np.minimum(x, 3., out=x)
+    if out != 'tr':
+        x -= 1.
+        x /= 2.
+        np.arccos(x, out=x)
+        if out == 'deg':
+            np.degrees(x, out=x)
+    return x
+
+
+def misorientation(A, B, out='deg', pairwise=False, **kwargs):
+    """
+    Calculates the misorientation between A e B. A and B can be single
+    orientations or lists of orientations, given either as rotation
+    matrices or as quaternions. Lists of orientations are processed in
+    blocks, so the memory needed does not depend on the number of pairs.
+
+    Parameters
+    ----------
+    A : numpy ndarray shape(3, 3), shape(N, 3, 3), shape(4) or shape(N, 4)
+        First rotation matrix(ces) (or quaternion(s))
+    B : numpy ndarray shape(3, 3), shape(M, 3, 3), shape(4) or shape(M, 4)
+        Second rotation matrix(ces) (or quaternion(s))
     out : str (optional)
         Unit of the output. Possible values are:
         'tr': as a trace value of the misorientation matrix
         'deg': as misorientation angle in degrees
         'rad': as misorientation angle in radians
         Default: 'deg'
+    pairwise : bool (optional)
+        If False, misorientations are calculated element-wise between A
+        and B, which must have the same length N (or one of them must be
+        a single orientation). If True, the misorientations between all
+        the pairs of orientations in A and B are calculated
+        Default: False
+    **kwargs :
+        blocksize : int (optional)
+            Maximum number of pairs of orientations processed at once
+            Default: 65536
 
     Returns
     -------
-    misang : float
-        Misorientation angle given in the unit specified by 'out'
-    """
-
-    C = list_cubic_symmetry_operators()
-    Adim, Bdim = np.ndim(A), np.ndim(B)
-
-    if (Adim == 2) and (Bdim == 2):
-        # Tj = Cj * A * B^T
-        T = np.tensordot(C, A.dot(B.T), axes=[[-1], [-2]])
-        tr = T.trace(axis1=1, axis2=2)
-        x = tr.max()  # Maximum trace
-        # This might happen due to rounding error
-        if x > 3.:
-            x = 3.
-        if out != 'tr':
-            x = np.arccos((x-1.)/2.)  # mis x in radians
-            if out == 'deg':
-                x = np.degrees(x)  # mis x in degrees
+    misang : float, numpy ndarray shape(N), or numpy ndarray shape(N, M)
+        Misorientation angle(s) given in the unit specified by 'out'
+    """
+    blocksize = max(1, kwargs.pop('blocksize', _misorientation_blocksize))
+
+    qA, singleA = _as_quaternions(A)
+    qB, singleB = _as_quaternions(B)
+    # (A * B^-1) is calculated instead of (A^-1 * B), which is equivalent
+    qB = _quaternion_conjugate(qB)
+
+    if pairwise:
+        N, M = len(qA), len(qB)
+        x = np.ndarray((N, M))
+        rows = max(1, blocksize//max(M, 1))
+        # A * B^-1 = L(A).B^-1, being L(A) the matrix shape(4, 4) of the
+        # left multiplication by A. Calculated as a matrix product
+        LA = _quaternion_left_matrix(qA)
+        for start in range(0, N, rows):
+            stop = min(start + rows, N)
+            # dq shape(stop - start, 4, M)
+            dq = np.dot(LA[start:stop].reshape(-1, 4), qB.T).reshape(-1, 4, M)
+            # Largest scalar part w among the rotations Cj * A * B^-1
+            w = _cubic_disorientation_w(dq, axis=1)
+            x[start:stop] = _w_to_misorientation(w, out)
     else:
-        raise Exception('Invalid shapes of arrays A or B')
+        if len(qA) != len(qB) and not (singleA or singleB):
+            raise Exception(('A and B have different lengths ({} and {}). Use pairwise=True '
+                             'to calculate the misorientations between all pairs').format(
+                                 len(qA), len(qB)))
+        N = max(len(qA), len(qB))
+        x = np.ndarray(N)
+        for start in range(0, N, blocksize):
+            stop = min(start + blocksize, N)
+            # Largest scalar part w among the rotations Cj * A * B^-1
+            w = _cubic_disorientation_w(quaternion_product(qA[start:stop] if not singleA else qA,
+                                                           qB[start:stop] if not singleB else qB))
+            x[start:stop] = _w_to_misorientation(w, out)
+
+        if singleA and singleB:
+            x = x[0]
+
     return x
 
 
+# Default memory budget (in bytes) of the temporary arrays used by
+# misorientation_neighbors and kernel_average_misorientation
+_neighbors_memory_limit = 2**28
+
+
+def _misorientation_neighbors_block(M, neighbors, sel, out, start, stop):
+    """
+    Misorientation angles between the pixels start:stop and their
+    neighbors. M must be provided as quaternions and sel as a boolean
+    array. Invalid values (neighbors out of the selection or of the scan)
+    are set to -1
+    """
+    nb = neighbors[start:stop]
+    M_block, sel_block = M[start:stop], sel[start:stop]
+
+    # 2D array to store the misorientation angles
+    misang = np.full(nb.shape, -1., dtype=float)
+
+    for k in range(nb.shape[1]):
+        # valid points, i.e., those part of the selection and with valid neighrbor index (> 0)
+        ok = (nb[:, k] >= 0) & sel_block & sel[nb[:, k]]
+        # Rotation from M[ok] to M[neighbors[ok, k]]
+        T = quaternion_product(M[nb[ok, k]], _quaternion_conjugate(M_block[ok]))
+        # Maximum scalar part w among the equivalent rotations (closed form
+        # for the cubic symmetry), converted to misorientation angle
+        misang[ok, k] = _w_to_misorientation(_cubic_disorientation_w(T), out)
+
+    return misang
+
+
+def _run_neighbors_blocks(process, M, neighbors, sel=None, **kwargs):
+    """
+    Calls process(M, sel, start, stop) for blocks of pixels start:stop
+    covering the whole scan. M is converted to quaternions and sel to a
+    boolean array. The size of the blocks is set such as the temporary
+    arrays do not exceed memory_limit bytes. If workers > 1, the blocks
+    (bands of rows of the scan) are processed in a pool of threads, each
+    one taking its share of memory_limit. The results of each block do
+    not depend on the other blocks, so process must write them to
+    disjoint slices of the output arrays.
+    """
+    memory_limit = kwargs.pop('memory_limit', None)
+    if memory_limit is None:
+        memory_limit = _neighbors_memory_limit
+    workers = kwargs.pop('workers', 1)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, workers)
+    verbose = kwargs.pop('verbose', True)
+
+    N = M.shape[0]
+    nneighbors = neighbors.shape[1]
+
+    # The disorientation is calculated using quaternions
+    if not _is_quaternion(M):
+        M = rotation_matrix_to_quaternion(M)
+
+    if not isinstance(sel, np.ndarray):
+        sel = np.full(N, True, dtype=bool)
+
+    # Approximate number of bytes per pixel: misang and the masks derived
+    # from it (K values per pixel), plus the quaternions and the temporary
+    # arrays of the misorientation kernel (calculated for one neighbor at
+    # a time)
+    bytes_per_pixel = 16*nneighbors + 300
+    if not isinstance(neighbors, np.ndarray):
+        # neighbors indices of the block computed by NeighborStencil
+        bytes_per_pixel += 40*nneighbors
+    blocksize = int(max(1, memory_limit//(workers*bytes_per_pixel)))
+    if workers > 1:
+        # a few blocks per thread, for load balancing
+        blocksize = min(blocksize, -(-N//(4*workers)))
+    blocks = [(start, min(start + blocksize, N)) for start in range(0, N, blocksize)]
+
+    if verbose:
+        t0 = time.time()
+        sys.stdout.write('Calculating misorientations for {} points for {} neighbors'.format(
+            np.count_nonzero(sel), nneighbors))
+        if len(blocks) > 1:
+            sys.stdout.write(' in {} blocks'.format(len(blocks)))
+        if workers > 1:
+            sys.stdout.write(' using {} threads'.format(workers))
+        sys.stdout.write('... ')
+        sys.stdout.flush()
+
+    if workers == 1 or len(blocks) == 1:
+        for start, stop in blocks:
+            process(M, sel, start, stop)
+    else:
+        from concurrent.futures import ThreadPoolExecutor
+
+        with ThreadPoolExecutor(workers) as pool:
+            futures = [pool.submit(process, M, sel, start, stop) for start, stop in blocks]
+            for future in futures:
+                future.result()  # raises the exceptions of the threads
+
+    if verbose:
+        sys.stdout.write('{:.2f} s\n'.format(time.time() - t0))
+        sys.stdout.flush()
+
+
 def misorientation_neighbors(M, neighbors, sel=None, out='deg', **kwargs):
     """
     Calculates the misorientation angle of every data point with respective
     orientation matrix provided in 'M' with respect to an arbitrary number 
     of neighbors, whose indices are provided in the 'neighbors' argument.
+    The data points are processed in blocks, whose size is set by the
+    memory budget 'memory_limit'. Use kernel_average_misorientation to
+    get only the average over the neighbors, without ever storing the
+    misorientation angles of all the data points.
 
     Parameters
     ----------
-    M : numpy ndarray shape(N, 3, 3)
-        List of rotation matrices describing the rotation from the sample 
-        coordinate frame to the crystal coordinate frame
-    neighbors : numpy ndarray shape(N, K) - K being the number of neighbors
-        Indices of the neighboring pixels
+    M : numpy ndarray shape(N, 3, 3) or shape(N, 4)
+        List of rotation matrices (or quaternions) describing the rotation
+        from the sample coordinate frame to the crystal coordinate frame
+    neighbors : numpy ndarray shape(N, K) or NeighborStencil
+        Indices of the neighboring pixels (K being the number of
+        neighbors), or stencil computing them block by block (see
+        ScanData.get_neighbor_stencil)
     sel : bool numpy 1D array (optional)
         Boolean array indicating data points calculations should be 
         performed
@@ -246,78 +668,44 @@ def misorientation_neighbors(M, neighbors, sel=None, out='deg', **kwargs):
         verbose : bool (optional)
             If True, prints computation time
             Default: True
+        memory_limit : int (optional)
+            Approximate maximum size, in bytes, of the temporary arrays
+            used in the calculation (the output is not included)
+            Default: 268435456 (256 MB)
+        workers : int (optional)
+            Number of threads. The blocks of data points are processed in
+            parallel, with results identical to the serial calculation.
+            If None, the number of CPUs is used
+            Default: 1
 
     Returns
     -------
     misang : numpy ndarray shape(N, K) - K being the number of neighbors
-        KAM : numpy ndarray shape(N) with KAM values
+        Misorientation angles. Invalid values are set to -1
     """
-    N = M.shape[0]
-    nneighbors = neighbors.shape[1]
-
-    C = list_cubic_symmetry_operators()
-
-    # 2D array to store trace values initialized as -2 (trace values are
-    # always in the [-1, 3] interval)
-    tr = np.full((N, nneighbors), -2., dtype=float)
-    # 2D array to store the misorientation angles in degrees
-    misang = np.full((N, nneighbors), -1., dtype=float)
-
-    if not isinstance(sel, np.ndarray):
-        sel = np.full(N, True, dtype=bool)
+    misang = np.ndarray(neighbors.shape, dtype=float)
 
-    verbose = kwargs.pop('verbose', True)
-    if verbose:
-        t0 = time.time()
-        sys.stdout.write('Calculating misorientations for {} points for {} neighbors'.format(
-            np.count_nonzero(sel), nneighbors))
-        sys.stdout.write(' [')
-        sys.stdout.flush()
-
-    for k in range(nneighbors):
-        # valid points, i.e., those part of the selection and with valid neighrbor index (> 0)
-        ok = (neighbors[:, k] >= 0) & sel & sel[neighbors[:, k]]
-        # Rotation from M[ok] to M[neighbors[ok, k]]
-        # Equivalent to np.matmul(M[neighbors[ok,k]], M[ok].transpose([0,2,1]))
-        T = np.einsum('ijk,imk->ijm', M[neighbors[ok, k]], M[ok])
-
-        for m in range(len(C)):
-            # Smart way to calculate the trace using einsum.
-            # Equivalent to np.matmul(C[m], T).trace(axis1=1, axis2=2)
-            a, b = C[m].nonzero()
-            ttr = np.einsum('j,ij->i', C[m, a, b], T[:, a, b])
-            tr[ok, k] = np.max(np.vstack([tr[ok, k], ttr]), axis=0)
-
-        if verbose:
-            if k > 0 and k < nneighbors:
-                sys.stdout.write(', ')
-            sys.stdout.write('{}'.format(k + 1))
-            sys.stdout.flush()
-
-    del T, ttr
-
-    if verbose:
-        sys.stdout.write('] in {:.2f} s\n'.format(time.time() - t0))
-        sys.stdout.flush()
-
-    # Take care of tr > 3. that might happend due to rounding errors
-    tr[tr > 3.] = 3.
+    def process(M, sel, start, stop):
+        misang[start:stop] = _misorientation_neighbors_block(M, neighbors, sel, out, start, stop)
 
-    # Filter out invalid trace values
-    ok = tr >= -1.
-    misang[ok] = trace_to_angle(tr[ok], out)
+    _run_neighbors_blocks(process, M, neighbors, sel, **kwargs)
     return misang
 
 
 def kernel_average_misorientation(M, neighbors, sel=None, maxmis=None, out='deg', **kwargs):
     """
-    Calculates the Kernel Average Misorientation (KAM)
-
-    M : numpy ndarray shape(N, 3, 3)
-        List of rotation matrices describing the rotation from the sample 
-        coordinate frame to the crystal coordinate frame
-    neighbors : numpy ndarray shape(N, K) - K being the number of neighbors
-        Indices of the neighboring pixels
+    Calculates the Kernel Average Misorientation (KAM). The misorientations
+    are calculated and averaged in blocks of data points (see
+    misorientation_neighbors), so the memory used does not depend on the
+    number of data points, apart from the input and output arrays.
+
+    M : numpy ndarray shape(N, 3, 3) or shape(N, 4)
+        List of rotation matrices (or quaternions) describing the rotation
+        from the sample coordinate frame to the crystal coordinate frame
+    neighbors : numpy ndarray shape(N, K) or NeighborStencil
+        Indices of the neighboring pixels (K being the number of
+        neighbors), or stencil computing them block by block (see
+        ScanData.get_neighbor_stencil)
     sel : bool numpy 1D array (optional)
         Boolean array indicating data points calculations should be 
         performed
@@ -331,34 +719,70 @@ def kernel_average_misorientation(M, neighbors, sel=None, maxmis=None, out='deg'
         verbose : bool (optional)
             If True, prints computation time
             Default: True
+        memory_limit : int (optional)
+            Approximate maximum size, in bytes, of the temporary arrays
+            used in the calculation
+            Default: 268435456 (256 MB)
+        workers : int (optional)
+            Number of threads. The blocks of data points are processed in
+            parallel, with results identical to the serial calculation.
+            If None, the number of CPUs is used
+            Default: 1
 
     Returns
     -------
     KAM : numpy ndarray shape(N) - M being the number of neighbors
         KAM : numpy ndarray shape(N) with KAM values
     """
-    misang = misorientation_neighbors(M, neighbors, sel, out, **kwargs)
-
-    outliers = misang < 0  # filter out negative values
-    if maxmis is not None:
-        outliers |= misang > maxmis  # and values > maxmis
-
-    misang[outliers] = 0.
-    nneighbors = np.count_nonzero(~outliers, axis=1)
+    misang_sum, nneighbors = _sum_misorientation_neighbors(M, neighbors, sel, maxmis, out,
+                                                           **kwargs)
 
     noneighbors = nneighbors == 0
     nneighbors[noneighbors] = 1  # to prevent division by 0
 
-    KAM = np.sum(misang, axis=1)/nneighbors
+    KAM = misang_sum/nneighbors
     KAM[noneighbors] = np.nan  # invalid KAM when nneighbors is 0
 
     return KAM
 
 
+def _sum_misorientation_neighbors(M, neighbors, sel=None, maxmis=None, out='deg', **kwargs):
+    """
+    Sum of the misorientation angles of each data point with respect to
+    its neighbors, calculated in blocks (see kernel_average_misorientation).
+    Values < 0 (invalid neighbors) and > maxmis are not accounted.
+
+    Returns
+    -------
+    misang_sum : numpy ndarray shape(N)
+        Sum of the misorientation angles
+    nneighbors : int numpy ndarray shape(N)
+        Number of neighbors accounted in the sum
+    """
+    misang_sum = np.ndarray(neighbors.shape[0], dtype=float)
+    nneighbors = np.ndarray(neighbors.shape[0], dtype=int)
+
+    def process(M, sel, start, stop):
+        misang = _misorientation_neighbors_block(M, neighbors, sel, out, start, stop)
+
+        outliers = misang < 0  # filter out negative values
+        if maxmis is not None:
+            outliers |= misang > maxmis  # and values > maxmis
+
+        misang[outliers] = 0.
+        nneighbors[start:stop] = np.count_nonzero(~outliers, axis=1)
+        misang_sum[start:stop] = np.sum(misang, axis=1)
+
+    _run_neighbors_blocks(process, M, neighbors, sel, **kwargs)
+    return misang_sum, nneighbors
+
+
 def minimize_disorientation(V, V0, **kwargs):
     """
     Calculates the orientation that truly minimizes the disorientation
     between the list of orientations V and a single orientation V0.
+    V is processed in chunks, so the temporary arrays do not depend on
+    the number of orientations.
     """
     n = kwargs.pop('n', 5)  # grid size
     maxdev = kwargs.pop('maxdev', .25)  # maximum deviation in degrees
@@ -366,6 +790,8 @@ def minimize_disorientation(V, V0, **kwargs):
     it = kwargs.pop('it', 3)  # number of iterations
     verbose = kwargs.pop('verbose', False)
     plot = kwargs.pop('plot', False)
+    # number of orientations V processed at once (64 MB of traces)
+    chunksize = max(1, 2**23//n**3)
     if verbose:
         sys.stdout.write('\nMinimizing disorientation...\n')
         sys.stdout.flush()
@@ -382,10 +808,14 @@ def minimize_disorientation(V, V0, **kwargs):
         A = euler_angles_to_rotation_matrix(theta, phi, psi, conv='xyz', verbose=False)
         # Rotate V0 by A. Resulting B is shape(n^3, 3, 3)
         B = np.tensordot(A, V0, axes=[[-1], [-2]])
-        # Calculate rotation from B to V. Resulting D is shape(len(V), n^3, 3, 3)
-        D = np.tensordot(V, B.transpose(0, 2, 1), axes=[[-1], [-2]]).transpose([0, 2, 1, 3])
+        # Trace of the rotation D = V B^T from B to V, i.e., the sum of the
+        # element-wise product of V and B, calculated for chunks of V.
         # Average (mean) trace of D along axis 0 shape(n^3)
-        tr = np.abs(np.trace(D, axis1=2, axis2=3)).mean(axis=0)
+        B9 = B.reshape(-1, 9).T
+        tr = np.zeros(len(B))
+        for start in range(0, len(V), chunksize):
+            tr += np.abs(np.dot(V[start:start+chunksize].reshape(-1, 9), B9)).sum(axis=0)
+        tr /= len(V)
         # Index of maximum trace value
         imax = np.argmax(tr)
         if verbose:
@@ -400,7 +830,7 @@ def minimize_disorientation(V, V0, **kwargs):
 
         V0 = A[imax].dot(V0)
         maxdev /= n
-    del A, B, D, tr
+    del A, B, B9, tr
 
     return V0
 
@@ -507,9 +937,18 @@ def rotation_matrix_to_euler_angles(R, conv='zxz', **kwargs):
             If True (default), print calculation time
         avg : boolean
             If True, calculates the Euler angles corresponding to the
-            average orientation.
+            average orientation (eigenvector method, see
+            average_orientation). The rotation matrices are supposed to
+            be already reduced to the same fundamental zone.
             If False (default), simply calculates the Euler angles for
             each rotation matrix provided.
+        refine : boolean
+            If True and avg is True, the average orientation is refined
+            by minimize_disorientation, to which the remaining kwargs are
+            passed. If None, the refinement is enabled when any of the
+            options of minimize_disorientation (n, maxdev, it, plot) is
+            provided, with a DeprecationWarning (see average_orientation)
+            Default: None
 
     """
 
@@ -549,14 +988,13 @@ def rotation_matrix_to_euler_angles(R, conv='zxz', **kwargs):
             sys.stdout.write('{:.2f} s\n'.format(time.time() - t0))
             sys.stdout.flush()
     else:
-        Phi = np.arccos(np.mean(R[:, 2, 2]))
-        sPhi = np.sin(Phi)
-        cphi1, cphi2 = -np.mean(R[:, 1, 2])/sPhi, np.mean(R[:, 2, 1])/sPhi
-        sphi1, sphi2 = np.mean(R[:, 0, 2])/sPhi, np.mean(R[:, 2, 0])/sPhi
-        phi1, phi2 = np.arctan2(sphi1, cphi1), np.arctan2(sphi2, cphi2)
-        R_avg = euler_angles_to_rotation_matrix(phi1, Phi, phi2, verbose=False)
-        # n=kwargs.pop('n', 5), maxdev=kwargs.pop('maxdev', .25)
-        R_avg = minimize_disorientation(R, R_avg, **kwargs)
+        kwargs.pop('verbose', None)
+        # q and -q contribute equally to A = sum(q q^T)
+        q = rotation_matrix_to_quaternion(R)
+        R_avg = quaternion_to_rotation_matrix(_eigen_quaternion_mean(np.dot(q.T, q)))
+        del q
+        if _pop_refine(kwargs, 'rotation_matrix_to_euler_angles'):
+            R_avg = minimize_disorientation(R, R_avg, **kwargs)
         phi1, Phi, phi2 = rotation_matrix_to_euler_angles(R_avg, verbose=False)  # recursive
 
     return phi1, Phi, phi2
@@ -598,6 +1036,256 @@ def axis_angle_to_rotation_matrix(axis, theta):
     return R
 
 
+def quaternion_product(p, q):
+    """
+    Hamilton product p*q of quaternions, i.e., the rotation q followed by
+    the rotation p
+
+    Parameters
+    ----------
+    p : numpy ndarray shape(4) or shape(N, 4)
+    q : numpy ndarray shape(4) or shape(N, 4)
+        Quaternions (w, x, y, z), scalar part first
+
+    Returns
+    -------
+    pq : numpy ndarray shape(4) or shape(N, 4)
+    """
+    p, q = np.asarray(p), np.asarray(q)
+    pw, px, py, pz = p[..., 0], p[..., 1], p[..., 2], p[..., 3]
+    qw, qx, qy, qz = q[..., 0], q[..., 1], q[..., 2], q[..., 3]
+    pq = np.empty(np.broadcast(p, q).shape)
+    pq[..., 0] = pw*qw - px*qx - py*qy - pz*qz
+    pq[..., 1] = pw*qx + px*qw + py*qz - pz*qy
+    pq[..., 2] = pw*qy - px*qz + py*qw + pz*qx
+    pq[..., 3] = pw*qz + px*qy - py*qx + pz*qw
+    return pq
+
+
+def _quaternion_conjugate(q):
+    """
+    Conjugate (inverse rotation) of the unit quaternions q
+    """
+    qc = np.array(q, dtype=float)
+    qc[..., 1:] *= -1.
+    return qc
+
+
+def _quaternion_left_matrix(p):
+    """
+    Matrices L(p) shape(N, 4, 4) such that the product p*q of the
+    quaternions p and q is equal to np.dot(L(p), q)
+    """
+    pw, px, py, pz = np.asarray(p, dtype=float).reshape(-1, 4).T
+    return np.stack([np.stack([pw, -px, -py, -pz], axis=1),
+                     np.stack([px, pw, -pz, py], axis=1),
+                     np.stack([py, pz, pw, -px], axis=1),
+                     np.stack([pz, -py, px, pw], axis=1)], axis=1)
+
+
+def _quaternion_positive(q):
+    """
+    Flips the sign of the quaternions whose scalar part is negative, so
+    that w >= 0. q and -q describe the same rotation
+    """
+    neg = q[..., 0] < 0.
+    q[neg] = -q[neg]
+    return q
+
+
+def _is_quaternion(M):
+    """
+    True if M is a (list of) quaternion(s), i.e., shape(4) or shape(N, 4),
+    False if M is a (list of) rotation matrix(ces)
+    """
+    return np.shape(M)[-1] == 4
+
+
+def rotation_matrix_to_quaternion(R):
+    """
+    Converts rotation matrices to unit quaternions (w, x, y, z), scalar
+    part first, with w >= 0
+
+    Parameters
+    ----------
+    R : numpy ndarray shape(3, 3) or shape(N, 3, 3)
+        Rotation matrix or list of rotation matrices
+
+    Returns
+    -------
+    q : numpy ndarray shape(4) or shape(N, 4)
+        Quaternion(s) describing the same rotation(s) as R
+    """
+    Rdim = np.ndim(R)
+    R = np.asarray(R, dtype=float).reshape(-1, 3, 3)
+
+    R00, R01, R02 = R[:, 0, 0], R[:, 0, 1], R[:, 0, 2]
+    R10, R11, R12 = R[:, 1, 0], R[:, 1, 1], R[:, 1, 2]
+    R20, R21, R22 = R[:, 2, 0], R[:, 2, 1], R[:, 2, 2]
+
+    # P = 4 q q^T calculated from the elements of R
+    P = np.empty((len(R), 4, 4))
+    P[:, 0, 0] = 1. + R00 + R11 + R22
+    P[:, 1, 1] = 1. + R00 - R11 - R22
+    P[:, 2, 2] = 1. - R00 + R11 - R22
+    P[:, 3, 3] = 1. - R00 - R11 + R22
+    P[:, 0, 1] = P[:, 1, 0] = R21 - R12
+    P[:, 0, 2] = P[:, 2, 0] = R02 - R20
+    P[:, 0, 3] = P[:, 3, 0] = R10 - R01
+    P[:, 1, 2] = P[:, 2, 1] = R01 + R10
+    P[:, 1, 3] = P[:, 3, 1] = R02 + R20
+    P[:, 2, 3] = P[:, 3, 2] = R12 + R21
+
+    # q is calculated from the row of P of its largest component
+    # (numerically stable)
+    n = np.arange(len(R))
+    k = np.argmax(P[:, [0, 1, 2, 3], [0, 1, 2, 3]], axis=1)
+    q = P[n, k]/(2.*np.sqrt(P[n, k, k])).reshape(-1, 1)
+
+    q = _quaternion_positive(q)
+
+    if Rdim == 2:
+        q = q.reshape(4)
+
+    return q
+
+
+def quaternion_to_rotation_matrix(q):
+    """
+    Converts unit quaternions (w, x, y, z) to rotation matrices
+
+    Parameters
+    ----------
+    q : numpy ndarray shape(4) or shape(N, 4)
+        Quaternion or list of quaternions, scalar part first
+
+    Returns
+    -------
+    R : numpy ndarray shape(3, 3) or shape(N, 3, 3)
+        Rotation matrix(ces) describing the same rotation(s) as q
+    """
+    qdim = np.ndim(q)
+    q = np.asarray(q, dtype=float).reshape(-1, 4)
+    w, x, y, z = q[:, 0], q[:, 1], q[:, 2], q[:, 3]
+
+    R = np.ndarray((len(q), 3, 3))
+    R[:, 0, 0] = 1. - 2.*(y*y + z*z)
+    R[:, 0, 1] = 2.*(x*y - w*z)
+    R[:, 0, 2] = 2.*(x*z + w*y)
+    R[:, 1, 0] = 2.*(x*y + w*z)
+    R[:, 1, 1] = 1. - 2.*(x*x + z*z)
+    R[:, 1, 2] = 2.*(y*z - w*x)
+    R[:, 2, 0] = 2.*(x*z - w*y)
+    R[:, 2, 1] = 2.*(y*z + w*x)
+    R[:, 2, 2] = 1. - 2.*(x*x + y*y)
+
+    if qdim == 1:
+        R = R.reshape(3, 3)
+
+    return R
+
+
+def euler_angles_to_quaternion(phi1, Phi, phi2, conv='zxz', **kwargs):
+    """
+    Given 3 Euler angles, calculates the quaternion (w, x, y, z) with
+    w >= 0 corresponding to the rotation R (active description) returned
+    by euler_angles_to_rotation_matrix.
+    Please notice that the Euler angles in the ang files follow passive
+    description.
+
+    Parameters:
+    -----------
+    phi1 : float or list, tuple, or array(N)
+    Phi : float or list, tuple, or array(N)
+    phi2 : float or list, tuple, or array(N)
+        Euler angles
+
+    conv : string (optional)
+        Rotation convention. Only zxz is supported
+        Default: zxz (Bunge notation)
+
+    **kwargs :
+        verbose : boolean
+            If True (default), print calculation time
+
+    """
+    if conv.lower() != 'zxz':
+        raise Exception('"{}" convention not supported'.format(conv))
+
+    verbose = kwargs.pop('verbose', True)
+    if verbose:
+        t0 = time.time()
+        sys.stdout.write('Calculating quaternions... ')
+        sys.stdout.flush()
+
+    ndim = np.ndim(phi1)
+    phi1 = np.asarray(phi1, dtype=float).reshape(-1)
+    Phi = np.asarray(Phi, dtype=float).reshape(-1)
+    phi2 = np.asarray(phi2, dtype=float).reshape(-1)
+    if len(phi1) != len(Phi) or len(phi1) != len(phi2):
+        raise Exception('Lengths of phi1, Phi, and phi2 differ')
+
+    # q = qz(phi1)*qx(Phi)*qz(phi2)
+    cPhi, sPhi = np.cos(Phi/2.), np.sin(Phi/2.)
+    plus, minus = (phi1 + phi2)/2., (phi1 - phi2)/2.
+
+    q = np.ndarray((len(phi1), 4))
+    q[:, 0] = cPhi*np.cos(plus)
+    q[:, 1] = sPhi*np.cos(minus)
+    q[:, 2] = sPhi*np.sin(minus)
+    q[:, 3] = cPhi*np.sin(plus)
+    q = _quaternion_positive(q)
+
+    if ndim == 0:
+        q = q.reshape(4)
+
+    if verbose:
+        sys.stdout.write('{:.2f} s\n'.format(time.time() - t0))
+        sys.stdout.flush()
+
+    return q
+
+
+def quaternion_to_euler_angles(q, conv='zxz'):
+    """
+    Calculates the Euler angles (zxz, Bunge notation) from a quaternion
+    or a sequence of quaternions (active description).
+    Please notice that the Euler angles in the ang files follow passive
+    description.
+
+    Parameters:
+    -----------
+    q : numpy array shape(4) or shape(N, 4)
+        Quaternion or list of quaternions (w, x, y, z)
+
+    conv : string (optional)
+        Rotation convention. Only zxz is supported
+        Default: zxz (Bunge notation)
+
+    Returns
+    -------
+    phi1, Phi, phi2 : float or numpy ndarray shape(N)
+        Euler angles. phi1 and phi2 in the range [0, 2pi]
+    """
+    if conv.lower() != 'zxz':
+        raise Exception('"{}" convention not supported'.format(conv))
+
+    qdim = np.ndim(q)
+    q = np.asarray(q, dtype=float).reshape(-1, 4)
+    w, x, y, z = q[:, 0], q[:, 1], q[:, 2], q[:, 3]
+
+    Phi = 2.*np.arctan2(np.hypot(x, y), np.hypot(w, z))
+    plus = np.arctan2(z, w)  # (phi1 + phi2)/2
+    minus = np.arctan2(y, x)  # (phi1 - phi2)/2
+    phi1 = np.mod(plus + minus, 2.*np.pi)
+    phi2 = np.mod(plus - minus, 2.*np.pi)
+
+    if qdim == 1:
+        phi1, Phi, phi2 = phi1[0], Phi[0], phi2[0]
+
+    return phi1, Phi, phi2
+
+
 """ Symmetry operations for the cubic system """
 
 
@@ -705,9 +1393,10 @@ def list_cubic_symmetry_operators_KS():
                       [0.,  0.,  1.]]])
 
 
-def list_cubic_symmetry_operators():
+def _build_cubic_symmetry_operators():
     """
-    Lists symmetry matrices for cubic symmetry group
+    Builds the symmetry matrices for cubic symmetry group from the axes
+    and the angles of the rotations
     """
     axis = np.array([[1., 0., 0.],
                      # 2-fold on <100>
@@ -772,13 +1461,105 @@ def list_cubic_symmetry_operators():
     return axis_angle_to_rotation_matrix(axis, angle).round(0).astype(int)
 
 
+# Functions building the symmetry matrices of each point group
+_symmetry_builders = {'cubic': _build_cubic_symmetry_operators}
+
+# Precomputed (read-only) tables of symmetry operators, indexed by
+# (group, representation, dtype). See get_symmetry_operators
+_symmetry_operators = {}
+
+# Precomputed (read-only) families of directions, indexed by (group, d)
+_family_directions = {}
+
+
+def get_symmetry_operators(group='cubic', representation='matrix', dtype=None):
+    """
+    Returns the table of symmetry operators of a point group. The tables
+    are computed once and shared by all the orientation functions. They
+    are read-only, so copy them before modifying.
+
+    Parameters
+    ----------
+    group : str (optional)
+        Point group. So far only 'cubic' is available
+        Default: 'cubic'
+    representation : str (optional)
+        'matrix' for rotation matrices shape(K, 3, 3) or 'quaternion' for
+        quaternions (w, x, y, z) shape(K, 4)
+        Default: 'matrix'
+    dtype : numpy dtype (optional)
+        Data type of the table (e.g., float, np.float32). If None, int is
+        used for matrices (whose elements are 0, 1, and -1) and float for
+        quaternions
+        Default: None
+
+    Returns
+    -------
+    ops : numpy ndarray shape(K, 3, 3) or shape(K, 4)
+        Symmetry operators, always in the same order
+    """
+    if dtype is None:
+        dtype = int if representation == 'matrix' else float
+    key = (group, representation, np.dtype(dtype))
+
+    ops = _symmetry_operators.get(key)
+    if ops is None:
+        try:
+            build = _symmetry_builders[group]
+        except KeyError:
+            raise Exception('Unknown point group "{}"'.format(group))
+
+        if representation == 'matrix':
+            ops = build()
+        elif representation == 'quaternion':
+            ops = rotation_matrix_to_quaternion(build())
+        else:
+            raise Exception('Unknown representation "{}"'.format(representation))
+
+        ops = ops.astype(dtype)
+        ops.flags.writeable = False
+        _symmetry_operators[key] = ops
+    return ops
+
+
+def list_cubic_symmetry_operators():
+    """
+    Lists symmetry matrices for cubic symmetry group. Returns a copy of
+    the shared table (see get_symmetry_operators)
+    """
+    return get_symmetry_operators('cubic', 'matrix').copy()
+
+
+def list_cubic_symmetry_quaternions():
+    """
+    Lists the quaternions (w, x, y, z) of the symmetry operators of the
+    cubic symmetry group, in the same order as list_cubic_symmetry_operators.
+    Returns a copy of the shared table (see get_symmetry_operators)
+    """
+    return get_symmetry_operators('cubic', 'quaternion').copy()
+
+
 def list_cubic_family_directions(d):
     """
-    Lists all the variants of a family of directions 'd'.
+    Lists all the variants of a family of directions 'd'
+    """
+    return _cubic_family_directions(d).copy()
+
+
+def _cubic_family_directions(d):
+    """
+    Variants of the family of directions 'd'. The variants of each family
+    are computed once, and the returned array is shared and read-only
     """
-    C = list_cubic_symmetry_operators()
-    var = set([tuple(v) for v in np.dot(C, d)])
-    return np.asarray(list(var))
+    key = ('cubic', tuple(np.asarray(d).ravel().tolist()))
+    var = _family_directions.get(key)
+    if var is None:
+        C = get_symmetry_operators('cubic', 'matrix')
+        var = set([tuple(v) for v in np.dot(C, d)])
+        var = np.asarray(list(var))
+        var.flags.writeable = False
+        _family_directions[key] = var
+    return var
 
 
 def reduce_cubic_transformations(V, maxdev=1e-3):
@@ -799,23 +1580,31 @@ def reduce_cubic_transformations(V, maxdev=1e-3):
     # Convert maxdev from angle in degrees to trace values [-1, 3]. Because
     # maxdev is very small, the new value of maxdev is very close to 3.
     maxdev = 2.*np.cos(np.radians(maxdev)) + 1.
-    C = list_cubic_symmetry_operators()
+    C = get_symmetry_operators('cubic', 'matrix', float)
 
-    pairs = []
     N = len(V)
-    for i in range(N):
-        p = []
-        U = np.dot(C, V[i])
-        for j in range(i, N):
-            tr = np.abs(np.trace(np.dot(U, V[j].T), axis1=1, axis2=2))
-            # From the trace tr you can get the misorientation angle
-            # The following "if" is equivalent to check if the misorientation
-            # angle is less the angle "maxdev"
-            if tr.max() >= maxdev:
-                p.append(j)
-        pairs.append(p)
-
-    unique = [p.pop() for p in pairs if len(p) == 1]
+    V9 = np.reshape(V, (N, 9))
+    # Rows of V processed at once (64 MB of traces)
+    blocksize = max(1, 2**23//(len(C)*N))
+
+    unique = []
+    for start in range(0, N, blocksize):
+        Vblock = V[start:start+blocksize]
+        n = len(Vblock)
+        # U[i, k] = C[k] V[i], flattened
+        U = np.matmul(C[np.newaxis], Vblock[:, np.newaxis]).reshape(-1, 9)
+        # trace(C[k] V[i] V[j]^T) is the sum of the element-wise product of
+        # C[k] V[i] and V[j]. From the trace tr you can get the misorientation
+        # angle, so tr >= maxdev is equivalent to check if the misorientation
+        # angle is less the angle "maxdev"
+        tr = np.abs(np.dot(U, V9.T)).reshape(n, len(C), N).max(axis=1)
+        # Pairs (i, j >= i) of equivalent transformations
+        equivalent = tr >= maxdev
+        equivalent[np.arange(n)[:, np.newaxis] + start > np.arange(N)] = False
+        # Transformations equivalent only to themselves among j >= i
+        single = np.count_nonzero(equivalent, axis=1) == 1
+        unique += list(np.argmax(equivalent[single], axis=1))
+
     Vprime = V[unique]
 
     return Vprime
@@ -831,9 +1620,9 @@ def IPF(M, d=[0, 0, 1]):
 
     Parameters
     ----------
-    M : numpy ndarray shape(N,3,3)
-        Rotation matrices describing the transformation from the sample 
-        coordinate frame to the crystal coordinate frame
+    M : numpy ndarray shape(N,3,3) or shape(N,4)
+        Rotation matrices (or quaternions) describing the transformation
+        from the sample coordinate frame to the crystal coordinate frame
     d : list or array shape(3)
         Reference direction in the sample coordinate frame.
 
@@ -842,10 +1631,17 @@ def IPF(M, d=[0, 0, 1]):
     uvw : crystallographic direction parallel to the direction 'd'
         uvw = M.d = (R^T).d
     """
-    if np.ndim(M) == 2:
-        M = M.reshape(1, 3, 3)
+    if _is_quaternion(M):
+        q = np.asarray(M).reshape(-1, 4)
+        d = np.asarray(d, dtype=float)
+        # d rotated by q: d + 2w(u x d) + 2u x (u x d), u = (x, y, z)
+        t = 2.*np.cross(q[:, 1:], d)
+        uvw = d + q[:, :1]*t + np.cross(q[:, 1:], t)
+    else:
+        if np.ndim(M) == 2:
+            M = M.reshape(1, 3, 3)
 
-    uvw = np.dot(M, d)  # dot product M.D
+        uvw = np.dot(M, d)  # dot product M.D
 
     return uvw/np.linalg.norm(uvw, axis=1).reshape(-1, 1)  # normalize uvw
 
@@ -873,7 +1669,7 @@ def PF(R, proj=[1, 0, 0], rotation=None):
         R = np.tensordot(R_prime, R, axes=[[-1], [-2]]).transpose([1, 0, 2])
 
     N = R.shape[0]
-    proj_variants = list_cubic_family_directions(d=proj)
+    proj_variants = _cubic_family_directions(d=proj)
     nvar = len(proj_variants)
     # normalize proj_variants
     proj_variants = proj_variants/np.linalg.norm(proj)
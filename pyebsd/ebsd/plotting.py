@@ -13,7 +13,7 @@ from .orientation import euler_angles_to_rotation_matrix, PF, IPF, stereographic
 from ..draw import modify_show, set_tight_plt, draw_circle_frame, toimage, ScaleBar
 from ..selection import LassoSelector2, RectangleSelector2
 
-__all__ = ['set_threshold_tiling', 'GridIndexing', 'EBSDMap', 'get_color_IPF',
+__all__ = ['set_threshold_tiling', 'GridIndexing', 'NeighborStencil', 'EBSDMap', 'get_color_IPF',
            'unit_triangle', 'plot_PF', 'plot_property', 'plot_IPF']
 
 __THRESHOLD_TILING__ = 10000
@@ -71,6 +71,10 @@ class GridIndexing(object):
 
         self.index = np.arange(self.N)
 
+        self._i = None  # row number
+        self._j = None  # col number
+        self._index_lattice = None
+
     @property
     def i(self):
         """
@@ -236,6 +240,232 @@ class GridIndexing(object):
 
         return self.ij_to_index(i, j)
 
+    @property
+    def lattice_shape(self):
+        """
+        Shape (nrows, ncols) of the 2D lattice layout (see to_lattice)
+        """
+        return (self.nrows, self.ncols)
+
+    @property
+    def index_lattice(self):
+        """
+        Pixel indices in the 2D lattice layout (see to_lattice). Padding
+        positions are set to -1
+        """
+        if self._index_lattice is None:
+            self._index_lattice = self.to_lattice(self.index, fill=-1)
+        return self._index_lattice
+
+    def _lattice_views(self, flat, img):
+        """
+        Returns list of pairs of views (flat[...], img[...]) of the arrays
+        in the flat and in the 2D lattice layouts covering all the pixels
+        """
+        if self.grid.lower() != 'hexgrid':
+            return [(flat.reshape(self.lattice_shape + flat.shape[1:]), img)]
+
+        # Even rows (i = 0, 2, ...) hold ncols_odd pixels and odd rows
+        # (i = 1, 3, ...) hold ncols_even pixels, at alternating columns
+        # j. j0 is the first column of the even rows (see ij_to_index)
+        j0 = 0 if self.ncols_odd > self.ncols_even else 1
+        npairs = self.nrows//2  # pairs of even and odd rows
+        n = npairs*self.ncols
+        pairs = flat[:n].reshape((npairs, self.ncols) + flat.shape[1:])
+        views = [(pairs[:, :self.ncols_odd], img[0:2*npairs:2, j0::2]),
+                 (pairs[:, self.ncols_odd:], img[1:2*npairs:2, 1-j0::2])]
+        if self.nrows % 2 == 1:  # last even row
+            views.append((flat[n:], img[-1, j0::2]))
+        return views
+
+    def to_lattice(self, prop, fill=np.nan):
+        """
+        Converts array of the pixels (flat layout, indexed by self.index)
+        to a 2D lattice layout shape(nrows, ncols) indexed by the grid
+        positions i, j (see ij_to_index). For HexGrid, the positions not
+        occupied by pixels (i and j with different parities) are padded
+        with 'fill'. Relative positions (di, dj) of neighbors become
+        simple shifts of the lattice (see shift_lattice), so kernels (e.g.,
+        scipy.ndimage filters) can work on contiguous memory.
+
+        Parameters
+        ----------
+        prop : numpy ndarray shape(N) or shape(N, ...)
+            Property of the pixels
+        fill : scalar (optional)
+            Value assigned to the padding positions of the lattice
+            Default: np.nan
+
+        Returns
+        -------
+        img : numpy ndarray shape(nrows, ncols) or shape(nrows, ncols, ...)
+            Property in the lattice layout
+        """
+        prop = np.ascontiguousarray(prop)
+        if prop.shape[0] != self.N:
+            raise Exception('prop must have {} elements along the first axis'.format(self.N))
+
+        img = np.full(self.lattice_shape + prop.shape[1:], fill,
+                      dtype=np.result_type(prop, fill))
+        for flat_view, img_view in self._lattice_views(prop, img):
+            img_view[...] = flat_view
+        return img
+
+    def from_lattice(self, img):
+        """
+        Converts array in the 2D lattice layout (see to_lattice) back to
+        the flat layout indexed by self.index
+
+        Parameters
+        ----------
+        img : numpy ndarray shape(nrows, ncols) or shape(nrows, ncols, ...)
+            Property in the lattice layout
+
+        Returns
+        -------
+        prop : numpy ndarray shape(N) or shape(N, ...)
+            Property of the pixels
+        """
+        img = np.asarray(img)
+        if img.shape[:2] != self.lattice_shape:
+            raise Exception('img must have shape {} along the first two axes'.format(
+                self.lattice_shape))
+
+        prop = np.ndarray((self.N,) + img.shape[2:], dtype=img.dtype)
+        for flat_view, img_view in self._lattice_views(prop, img):
+            flat_view[...] = img_view
+        return prop
+
+    @staticmethod
+    def shift_lattice(img, di, dj, fill=np.nan):
+        """
+        Shifts array in the 2D lattice layout (see to_lattice) such as
+        out[i, j] = img[i + di, j + dj], i.e., out holds for every position
+        the value of its neighbor at the relative position (di, dj).
+        Positions whose neighbors fall out of the lattice are set to 'fill'
+
+        Parameters
+        ----------
+        img : numpy ndarray shape(nrows, ncols) or shape(nrows, ncols, ...)
+            Property in the lattice layout
+        di : int
+            Shift along the rows (i)
+        dj : int
+            Shift along the columns (j)
+        fill : scalar (optional)
+            Value assigned to positions without neighbors
+            Default: np.nan
+
+        Returns
+        -------
+        out : numpy ndarray with the same shape of img
+            Shifted array
+        """
+        nrows, ncols = img.shape[:2]
+        out = np.full(img.shape, fill, dtype=np.result_type(img, fill))
+        if abs(di) < nrows and abs(dj) < ncols:
+            dst_i = slice(max(0, -di), nrows - max(0, di))
+            dst_j = slice(max(0, -dj), ncols - max(0, dj))
+            src_i = slice(max(0, di), nrows - max(0, -di))
+            src_j = slice(max(0, dj), ncols - max(0, -dj))
+            out[dst_i, dst_j] = img[src_i, src_j]
+        return out
+
+
+class NeighborStencil(object):
+    """
+    Neighbors of every pixel of a grid described by a stencil, i.e., the
+    relative positions (j_shift, i_shift) of the neighbors with respect
+    to the central pixel. The indices of the neighbors are calculated on
+    the fly for blocks of pixels, so NeighborStencil can be used in
+    place of the N x K array returned by ScanData.get_neighbors (e.g., by
+    misorientation_neighbors and kernel_average_misorientation) without
+    ever storing it.
+
+    Parameters
+    ----------
+    grid : GridIndexing
+        Grid geometry (e.g., ScanData object)
+    j_shift : list of int
+        Relative indices of the neighbors along the columns (x)
+    i_shift : list of int
+        Relative indices of the neighbors along the rows (y)
+    sel : bool numpy 1D array (optional)
+        Boolean array indicating data points calculations should be
+        performed. The neighbors of the pixels out of the selection are
+        set to -1
+        Default: None
+
+    Example
+    -------
+    >>> stencil = scan.get_neighbor_stencil(distance=2)
+    >>> stencil[1000:2000]  # neighbors of the pixels 1000 to 1999
+    """
+    # Number of pixels per block in toarray
+    blocksize = 2**16
+
+    def __init__(self, grid, j_shift, i_shift, sel=None):
+        if len(j_shift) != len(i_shift):
+            raise Exception('j_shift and i_shift must have the same length')
+        self.grid = grid
+        self.j_shift = np.asarray(j_shift, dtype=int)
+        self.i_shift = np.asarray(i_shift, dtype=int)
+        self.sel = sel
+
+    @property
+    def shape(self):
+        """
+        Shape (N, K) of the equivalent array of neighbors indices
+        """
+        return (self.grid.N, len(self.j_shift))
+
+    def __len__(self):
+        return self.grid.N
+
+    def __getitem__(self, key):
+        """
+        Indices of the neighbors of the pixels start:stop. Only slices
+        are supported
+        """
+        if not isinstance(key, slice):
+            raise Exception('NeighborStencil only supports slices (e.g., stencil[start:stop])')
+        start, stop, step = key.indices(self.grid.N)
+        return self._block(start, stop, step)
+
+    def _block(self, start, stop, step=1):
+        i, j = self.grid.i[start:stop:step], self.grid.j[start:stop:step]
+
+        j_neighbors = np.add.outer(j, self.j_shift)
+        i_neighbors = np.add.outer(i, self.i_shift)
+
+        # i, j out of allowed range
+        outliers = (j_neighbors < 0) | (j_neighbors >= self.grid.ncols) | (
+            i_neighbors < 0) | (i_neighbors >= self.grid.nrows)
+
+        neighbors_ind = self.grid.ij_to_index(i_neighbors, j_neighbors)
+        neighbors_ind[outliers] = -1
+        if self.sel is not None:
+            neighbors_ind[~self.sel[start:stop:step]] = -1
+
+        return neighbors_ind
+
+    def toarray(self):
+        """
+        Returns the indices of the neighbors of every pixel as a numpy
+        ndarray shape(N, K), calculated block by block
+
+        Returns
+        -------
+        neighbors_ind : numpy ndarray shape(N, K)
+            Indices of the neighboring pixels
+        """
+        N = self.grid.N
+        neighbors_ind = np.ndarray(self.shape, dtype=int)
+        for start in range(0, N, self.blocksize):
+            stop = min(start + self.blocksize, N)
+            neighbors_ind[start:stop] = self._block(start, stop)
+        return neighbors_ind
+
 
 class CoordsFormatter(object):
     """
@@ -1002,9 +1232,9 @@ def plot_IPF(M, nrows, ncols_odd, ncols_even, x, y, grid, dx=None, dy=None,
 
     Parameters
     ----------
-    M : numpy ndarray shape(N,3,3)
-        Transformation matrix from the sample coordinate frame to
-        the crystal coordinate frame.
+    M : numpy ndarray shape(N,3,3) or shape(N,4)
+        Transformation matrix (or quaternion) from the sample coordinate
+        frame to the crystal coordinate frame.
     nrows : int
         Number of rows
     ncols_odd : int
@@ -1,13 +1,21 @@
 # -*- coding: utf-8 -*-
 
+import os
+import sys
+import gzip
+import time
 import numpy as np
+import pandas as pd
 from itertools import cycle
+from collections import OrderedDict
 from matplotlib import rcParams
 import matplotlib.pyplot as plt
 
-from .orientation import (euler_angles_to_rotation_matrix, misorientation,
-                          kernel_average_misorientation)
-from .plotting import GridIndexing, EBSDMap, plot_property, plot_IPF, plot_PF
+from .orientation import (euler_angles_to_rotation_matrix, euler_angles_to_quaternion,
+                          quaternion_to_euler_angles, misorientation, misorientation_neighbors,
+                          _quaternion_conjugate, _average_quaternions_labels,
+                          _sum_misorientation_labels)
+from .plotting import GridIndexing, NeighborStencil, EBSDMap, plot_property, plot_IPF, plot_PF
 
 __all__ = ['ScanData', 'selection_to_scandata']
 
@@ -31,6 +39,18 @@ rcParams['savefig.bbox'] = 'tight'
 rcParams['savefig.pad_inches'] = 0.0
 
 
+# Number of lines formatted at once by ScanData.save_ang_file
+_ang_write_chunksize = 100000
+
+# Approximate maximum size, in bytes, of the misorientation cache of ScanData.
+# 0 disables the cache
+_misorientation_cache_limit = 0
+
+# Values assigned to pixels out of the selection in selection_to_scandata
+_unselected_values = {'phi1': 4., 'Phi': 4., 'phi2': 4., 'IQ': -1, 'CI': -2,
+                      'ph': -1, 'intensity': -1, 'fit': 0}
+
+
 class ScanData(GridIndexing):
     """
     EBSD scan data
@@ -58,6 +78,21 @@ class ScanData(GridIndexing):
     header : str (optional)
         Header of the scan data file
         Default: ''
+    mmap_dir : str (optional)
+        Directory where arrays derived from data (e.g., the rotation
+        matrices R) are stored as memory-mapped .npy files. The files are
+        computed block by block the first time they are accessed and
+        reused afterwards. If None, derived arrays are kept in memory
+        Default: None
+
+    The misorientation angles between each pixel and its neighbor at a
+    given grid offset (di, dj) can be cached, so that the calculations of
+    KAM for different distances (and of other quantities derived from the
+    misorientations between neighbors) share them. The cache is disabled
+    by default; set the attribute misorientation_cache_limit to its
+    maximum size in bytes to enable it. The least recently used arrays
+    are discarded first. Use clear_misorientation_cache to free the
+    memory.
     """
     __2pi = 2*np.pi
     __cos60 = .5  # cos(60deg)
@@ -65,6 +100,9 @@ class ScanData(GridIndexing):
 
     colors = ['red', 'green', 'blue', 'cyan', 'magenta', 'yellow']
 
+    # Columns that data must contain
+    required_columns = ['phi1', 'Phi', 'phi2', 'x', 'y', 'ph']
+
     neighbors_hexgrid_fixed = [
         # 1st neighbors
         [[2, 0], [1, 1], [-1, 1], [-2, 0], [-1, -1], [1, -1]],
@@ -95,7 +133,11 @@ class ScanData(GridIndexing):
 
     __n_neighbors_hexgrid_fixed = len(neighbors_hexgrid_fixed)
 
-    def __init__(self, data, grid, dx, dy, ncols_odd, ncols_even, nrows, header=''):
+    # Number of pixels per block when computing memory-mapped arrays
+    mmap_blocksize = 2**20
+
+    def __init__(self, data, grid, dx, dy, ncols_odd, ncols_even, nrows, header='',
+                 mmap_dir=None):
         # Initializes base class GridIndexing
         super(ScanData, self).__init__(grid, ncols_odd, ncols_even, nrows, dx, dy)
 
@@ -105,13 +147,24 @@ class ScanData(GridIndexing):
                              '({})').format(len(data), self.N))
 
         self.header = header  # string
+        self.mmap_dir = mmap_dir
+
+        missing = [col for col in self.required_columns if col not in data.columns]
+        if missing:
+            raise Exception('Missing compulsory columns: {}'.format(', '.join(missing)))
 
         # Compulsory columns in data
         # (.values: pandas Series to numpy array)
+        # makes sure min(x) == 0 and min(y) == 0. The arrays are only
+        # modified when necessary, so memory-mapped columns are not touched
         self.x = self.data.x.values
-        self.x -= self.x.min()  # makes sure min(x) == 0
+        xmin = self.x.min()
+        if xmin != 0:
+            self.x -= xmin
         self.y = self.data.y.values
-        self.y -= self.y.min()  # makes sure min(y) == 0
+        ymin = self.y.min()
+        if ymin != 0:
+            self.y -= ymin
         self.phi1 = self.data.phi1.values
         self.Phi = self.data.Phi.values
         self.phi2 = self.data.phi2.values
@@ -122,20 +175,18 @@ class ScanData(GridIndexing):
         self.ph = self.data.ph.values
 
         # Optional columns
-        try:
+        if 'IQ' in self.data.columns:
             self.IQ = self.data.IQ.values
-        except:
-            pass
-        try:
+        if 'CI' in self.data.columns:
             self.CI = self.data.CI.values
-        except:
-            pass
-
-        self._i = None  # row number
-        self._j = None  # col number
 
         self._M = None
         self._R = None
+        self._q = None
+
+        # misorientation angles between neighbors, keyed by grid offset
+        self._misorientation_cache = OrderedDict()
+        self.misorientation_cache_limit = _misorientation_cache_limit
 
         # keeps history of Figure, AxesSubplot and EBSDMap objects in these
         # lists. self.clear_history() can be used to clear the history
@@ -160,10 +211,73 @@ class ScanData(GridIndexing):
         sample coordinate frame of the EBSD system.
         """
         if self._R is None:
-            self._R = euler_angles_to_rotation_matrix(
-                self.phi1, self.Phi, self.phi2)
+            if self.mmap_dir is None:
+                self._R = euler_angles_to_rotation_matrix(
+                    self.phi1, self.Phi, self.phi2)
+            else:
+                self._R = self._get_memmap('R', (self.N, 3, 3), self._compute_R_block)
         return self._R
 
+    def _compute_R_block(self, R, start, stop):
+        R[start:stop] = euler_angles_to_rotation_matrix(
+            self.phi1[start:stop], self.Phi[start:stop], self.phi2[start:stop],
+            verbose=False)
+
+    @property
+    def q(self):
+        """
+        Unit quaternions (w, x, y, z), with w >= 0, describing the same
+        rotation as M, i.e., from the sample coordinate frame to the crystal
+        coordinate frame. q takes 4 floats per pixel, instead of 9 for M
+        """
+        if self._q is None:
+            if self.mmap_dir is None:
+                self._q = euler_angles_to_quaternion(self.phi1, self.Phi, self.phi2)
+                self._q[:, 1:] *= -1.  # M = R^T, i.e., the conjugate of R
+            else:
+                self._q = self._get_memmap('q', (self.N, 4), self._compute_q_block)
+        return self._q
+
+    def _compute_q_block(self, q, start, stop):
+        q[start:stop] = euler_angles_to_quaternion(
+            self.phi1[start:stop], self.Phi[start:stop], self.phi2[start:stop],
+            verbose=False)
+        q[start:stop, 1:] *= -1.
+
+    def _get_memmap(self, name, shape, compute_block, dtype=float):
+        """
+        Returns the memory-mapped array 'name' stored in mmap_dir. If the
+        file does not exist yet, it is created and filled block by block
+        by calling compute_block(array, start, stop)
+        """
+        fname = os.path.join(self.mmap_dir, name + '.npy')
+        if os.path.isfile(fname):
+            arr = np.load(fname, mmap_mode='r')
+            if arr.shape == shape and arr.dtype == dtype:
+                return arr
+            del arr
+
+        t0 = time.time()
+        sys.stdout.write('Calculating {} (memory-mapped)... '.format(name))
+        sys.stdout.flush()
+
+        # The array is written to a temporary file, which is renamed only
+        # after it is complete
+        fname_tmp = fname + '.tmp'
+        arr = np.lib.format.open_memmap(fname_tmp, mode='w+', dtype=dtype, shape=shape)
+        for start in range(0, shape[0], self.mmap_blocksize):
+            compute_block(arr, start, min(start + self.mmap_blocksize, shape[0]))
+        arr.flush()
+        del arr
+        if os.path.isfile(fname):
+            os.remove(fname)
+        os.rename(fname_tmp, fname)
+
+        sys.stdout.write('{:.2f} s\n'.format(time.time() - t0))
+        sys.stdout.flush()
+
+        return np.load(fname, mmap_mode='r')
+
     def get_neighbors_oim(self, distance):
         """
         Returns list of relative indices of the neighboring pixels for
@@ -248,6 +362,35 @@ class ScanData(GridIndexing):
             neighbors
             Indices of the neighboring pixels
         """
+        return self.get_neighbor_stencil(distance, perimeteronly, distance_convention,
+                                         sel).toarray()
+
+    def get_neighbor_stencil(self, distance, perimeteronly=True, distance_convention='OIM',
+                             sel=None):
+        """
+        Returns the stencil of the neighboring pixels for a given distance
+        in pixels. The stencil computes the indices of the neighbors on
+        the fly for blocks of pixels and can be used in place of the array
+        returned by get_neighbors, e.g., in misorientation_neighbors and
+        kernel_average_misorientation, without ever allocating it
+
+        Arguments
+        ---------
+        Same as get_neighbors
+
+        Returns
+        -------
+        stencil : NeighborStencil object
+            Stencil of the neighboring pixels
+        """
+        j_shift, i_shift = self._get_shifts(distance, perimeteronly, distance_convention)
+        return NeighborStencil(self, j_shift, i_shift, sel)
+
+    def _get_shifts(self, distance, perimeteronly=True, distance_convention='OIM'):
+        """
+        Returns lists of relative indices (j_shift, i_shift) of the
+        neighboring pixels (see get_neighbors)
+        """
         if distance_convention.lower() == 'oim':
             _get_neighbors = self.get_neighbors_oim
         elif distance_convention.lower() == 'fixed':
@@ -267,26 +410,7 @@ class ScanData(GridIndexing):
                 j_shift += j_sh
                 i_shift += i_sh
 
-        n_neighbors = len(j_shift)
-        if sel is None:
-            sel = np.full(self.N, True, dtype=bool)
-
-        # x
-        j_neighbors = np.full((self.N, n_neighbors), -1, dtype=int)
-        j_neighbors[sel] = np.add.outer(self.j[sel], j_shift)
-        # y
-        i_neighbors = np.full((self.N, n_neighbors), -1, dtype=int)
-        i_neighbors[sel] = np.add.outer(self.i[sel], i_shift)
-
-        # i, j out of allowed range
-        outliers = (j_neighbors < 0) | (j_neighbors >= self.ncols) | (
-            i_neighbors < 0) | (i_neighbors >= self.nrows)
-
-        neighbors_ind = np.full((self.N, n_neighbors), -1, dtype=int)
-        neighbors_ind[sel] = self.ij_to_index(i_neighbors[sel], j_neighbors[sel])
-        neighbors_ind[outliers] = -1
-
-        return neighbors_ind.astype(int)
+        return j_shift, i_shift
 
     def get_distance_neighbors(self, distance, distance_convention='OIM'):
         """
@@ -327,10 +451,201 @@ class ScanData(GridIndexing):
 
         return d.mean()
 
+    def _get_offset_neighbors(self, dj, di):
+        """
+        Returns indices of the neighbors at the relative position (di, dj)
+        of every pixel (-1 for neighbors out of the scan)
+        """
+        return self.from_lattice(self.shift_lattice(self.index_lattice, di, dj, fill=-1))
+
+    def _offset_misorientation(self, dj, di, sel=None, **kwargs):
+        """
+        Returns the misorientation angles (in degrees) between every pixel
+        and its neighbor at the relative position (di, dj), and the indices
+        of the neighbors (see _get_offset_neighbors). Invalid values
+        (neighbors out of the scan or of the selection) are set to -1.
+        (di, dj) must be in the half of the stencil with di > 0, or di == 0
+        and dj >= 0. The misorientation between pixels a and b is the same
+        as between b and a, so the opposite offset is obtained with
+        _opposite_offset_misorientation. If sel is None, the misorientation
+        angles are stored in the misorientation cache (when enabled).
+        Otherwise, only the pairs of selected pixels are calculated
+        """
+        neighbors = self._get_offset_neighbors(dj, di)
+        if sel is not None:
+            misang = misorientation_neighbors(self.q, neighbors.reshape(-1, 1), sel,
+                                              verbose=False, **kwargs)[:, 0]
+            return misang, neighbors
+
+        key = (di, dj)
+        misang = self._misorientation_cache.get(key)
+        if misang is None:
+            misang = misorientation_neighbors(self.q, neighbors.reshape(-1, 1),
+                                              verbose=False, **kwargs)[:, 0]
+            self._cache_misorientation(key, misang)
+        else:
+            self._misorientation_cache.move_to_end(key)
+
+        return misang, neighbors
+
+    def _opposite_offset_misorientation(self, misang, neighbors):
+        """
+        Misorientation angles between every pixel and its neighbor at the
+        relative position (-di, -dj), given the misorientation angles misang
+        and the neighbors at the relative position (di, dj)
+        """
+        misang_opposite = np.full(self.N, -1., dtype=float)
+        ok = misang >= 0
+        misang_opposite[neighbors[ok]] = misang[ok]
+        return misang_opposite
+
+    def _cache_misorientation(self, key, misang):
+        """
+        Stores misang in the misorientation cache, discarding the least
+        recently used arrays when misorientation_cache_limit is exceeded
+        """
+        misang.setflags(write=False)
+        if misang.nbytes > self.misorientation_cache_limit:
+            return
+
+        self._misorientation_cache[key] = misang
+        size = sum([arr.nbytes for arr in self._misorientation_cache.values()])
+        while size > self.misorientation_cache_limit:
+            _, arr = self._misorientation_cache.popitem(last=False)
+            size -= arr.nbytes
+
+    def clear_misorientation_cache(self):
+        """
+        Clears the cache of misorientation angles between neighbors
+        """
+        self._misorientation_cache.clear()
+
+    def _iter_offset_misorientation(self, j_shift, i_shift, sel=None, **kwargs):
+        """
+        Yields, for each neighbor k given by the relative indices j_shift,
+        i_shift, the tuple (k, misang), misang being the misorientation
+        angles (in degrees) between every pixel and that neighbor. Invalid
+        values (neighbors out of the scan or of the selection) are set to
+        -1. The offsets (di, dj) and (-di, -dj) are processed together, so
+        the misorientation angles of each pair of opposite neighbors are
+        calculated only once
+        """
+        verbose = kwargs.pop('verbose', True)
+        kwargs.pop('out', None)
+
+        if verbose:
+            t0 = time.time()
+            sys.stdout.write('Calculating misorientations for {} points for {} neighbors... '.format(
+                self.N if sel is None else np.count_nonzero(sel), len(j_shift)))
+            sys.stdout.flush()
+
+        offsets = list(zip(j_shift, i_shift))
+        done = [False]*len(offsets)
+        for k, (dj, di) in enumerate(offsets):
+            if done[k]:
+                continue
+            done[k] = True
+
+            # Index of the opposite neighbor, if it is part of the stencil
+            kopp = None
+            for m in range(k + 1, len(offsets)):
+                if not done[m] and offsets[m] == (-dj, -di):
+                    kopp = m
+                    done[m] = True
+                    break
+
+            if di > 0 or (di == 0 and dj >= 0):
+                misang, neighbors = self._offset_misorientation(dj, di, sel, **kwargs)
+                yield k, misang
+                if kopp is not None:
+                    yield kopp, self._opposite_offset_misorientation(misang, neighbors)
+            else:
+                misang, neighbors = self._offset_misorientation(-dj, -di, sel, **kwargs)
+                if kopp is not None:
+                    yield kopp, misang
+                yield k, self._opposite_offset_misorientation(misang, neighbors)
+            del misang, neighbors
+
+        if verbose:
+            sys.stdout.write('{:.2f} s\n'.format(time.time() - t0))
+            sys.stdout.flush()
+
+    def _sum_offset_misorientation(self, j_shift, i_shift, sel=None, maxmis=None, **kwargs):
+        """
+        Sum of the misorientation angles (in degrees) between every pixel
+        and its neighbors given by the relative indices j_shift, i_shift,
+        and number of neighbors accounted in the sum. Values > maxmis are
+        not accounted
+        """
+        misang_sum = np.zeros(self.N, dtype=float)
+        nneighbors = np.zeros(self.N, dtype=int)
+
+        for _, misang in self._iter_offset_misorientation(j_shift, i_shift, sel, **kwargs):
+            ok = misang >= 0
+            if maxmis is not None:
+                ok &= misang <= maxmis
+            np.add(misang_sum, misang, out=misang_sum, where=ok)
+            nneighbors += ok
+
+        return misang_sum, nneighbors
+
+    def get_misorientation_neighbors(self, distance=1, perimeteronly=True,
+                                     distance_convention='OIM', sel=None, **kwargs):
+        """
+        Returns the misorientation angles between every pixel and its
+        neighbors. Equivalent to misorientation_neighbors(self.q,
+        self.get_neighbors(...), sel), but the misorientation angles of
+        each pair of opposite neighbors are calculated only once and, if
+        the misorientation cache is enabled and sel is None, shared with
+        other calls
+
+        Parameters
+        ----------
+        distance : int (optional)
+            Distance (in neighbor indexes) to the kernel
+            Default: 1
+        perimeteronly : bool (optional)
+            If True, considers only pixels in the perimeter. If False, then
+            also includes innermost pixels
+            Default: True
+        distance_convention : str (optional)
+            Distance convention used for selecting the neighboring pixels.
+            'OIM' or 'fixed' (see get_neighbors)
+            Default : OIM
+        sel : bool numpy 1D array (optional)
+            Boolean array indicating data points calculations should be
+            performed
+            Default: None
+
+        **kwargs :
+            kwargs parameters are passed to misorientation_neighbors,
+            e.g., verbose, memory_limit and workers
+
+        Returns
+        -------
+        misang : numpy ndarray shape(N, K) - K being the number of neighbors
+            Misorientation angles in degrees. Invalid values are set to -1
+        """
+        j_shift, i_shift = self._get_shifts(distance, perimeteronly, distance_convention)
+
+        misang = np.ndarray((self.N, len(j_shift)), dtype=float)
+        for k, mis in self._iter_offset_misorientation(j_shift, i_shift, sel, **kwargs):
+            misang[:, k] = mis
+
+        return misang
+
     def get_KAM(self, distance=1, perimeteronly=True, maxmis=None,
                 distance_convention='OIM', sel=None, **kwargs):
         """
-        Returns Kernel average misorientation map
+        Returns Kernel average misorientation map. The misorientation
+        angles of each pair of opposite neighbors are calculated only once.
+        The misorientation cache is disabled by default. If it is enabled
+        by setting misorientation_cache_limit (in bytes), the misorientation
+        angles between neighbors are kept in memory after the call (up to
+        misorientation_cache_limit bytes, i.e., 8*N bytes per neighbor
+        offset) and reused by subsequent calls. Calls with sel do not use
+        the cache; only the misorientations between selected pixels are
+        calculated
 
         Parameters
         ----------
@@ -349,13 +664,334 @@ class ScanData(GridIndexing):
             Boolean array indicating which data points should be plotted
             Default: None
 
+        **kwargs :
+            kwargs parameters are passed to misorientation_neighbors,
+            e.g., verbose, memory_limit (approximate maximum size, in
+            bytes, of the temporary arrays), and workers (number of
+            threads)
+
         Returns
         -------
         KAM : numpy ndarray shape(N) with KAM values in degrees
         """
-        neighbors = self.get_neighbors(distance, perimeteronly, distance_convention, sel)
-        return kernel_average_misorientation(self.M, neighbors, sel, maxmis,
-                                             kwargs.pop('out', 'deg'), **kwargs)
+        out = kwargs.pop('out', 'deg')
+
+        j_shift, i_shift = self._get_shifts(distance, perimeteronly, distance_convention)
+        misang_sum, nneighbors = self._sum_offset_misorientation(j_shift, i_shift, sel,
+                                                                 maxmis, **kwargs)
+
+        KAM = np.full(self.N, np.nan)  # invalid KAM when nneighbors is 0
+        ok = nneighbors > 0
+        KAM[ok] = misang_sum[ok]/nneighbors[ok]
+
+        if out == 'rad':
+            KAM = np.radians(KAM)
+        return KAM
+
+    def get_KAM_profile(self, distances=[1, 2, 3, 4, 5], perimeteronly=True, maxmis=None,
+                        distance_convention='OIM', sel=None, **kwargs):
+        """
+        Returns Kernel average misorientation maps for several distances
+        and the linear fit of KAM vs distance for every pixel, whose slope
+        is proportional to the density of geometrically necessary
+        dislocations (GND). The misorientations of each neighbor shell are
+        calculated only once, so the result is equivalent to (but faster
+        than) calling get_KAM for each distance.
+
+        Parameters
+        ----------
+        distances : list of int (optional)
+            Distances (in neighbor indexes) to the kernel
+            Default: [1, 2, 3, 4, 5]
+        perimeteronly : bool (optional)
+            If True, KAM is calculated using only pixels in the perimeter,
+            else uses inner pixels as well
+            Default: True
+        maxmis : float (optional)
+            Maximum misorientation angle (in degrees) accounted in the
+            calculation of KAM
+            Default: None
+        distance_convention : str (optional)
+            Distance convention used for selecting the neighboring pixels.
+            'OIM' or 'fixed' (see get_neighbors)
+            Default : OIM
+        sel : bool numpy 1D array (optional)
+            Boolean array indicating data points calculations should be
+            performed
+            Default: None
+
+        **kwargs :
+            kwargs parameters are passed to misorientation_neighbors,
+            e.g., verbose, memory_limit and workers
+
+        Returns
+        -------
+        KAM : numpy ndarray shape(N, D) - D being the number of distances
+            KAM values in degrees for each distance
+        distance : numpy ndarray shape(D)
+            Distance, in um, to the n-th neighbor for each distance (see
+            get_distance_neighbors)
+        slope : numpy ndarray shape(N)
+            Slope of the linear fit of KAM vs distance (in degrees/um)
+        intercept : numpy ndarray shape(N)
+            Intercept of the linear fit of KAM vs distance (in degrees)
+        Rsquared : numpy ndarray shape(N)
+            Coefficient of determination (R²) of the linear fit
+        """
+        distances = np.asarray(distances, dtype=int).ravel()
+        if len(distances) == 0 or distances.min() < 1:
+            raise Exception('get_KAM_profile: distances must be integers >= 1')
+
+        D = len(distances)
+        KAM = np.full((self.N, D), np.nan)
+        distance = np.array([self.get_distance_neighbors(d, distance_convention)
+                             for d in distances])
+
+        # Only shells used by the requested distances are calculated
+        if perimeteronly:
+            shells = np.unique(distances)
+        else:
+            shells = np.arange(1, distances.max() + 1)
+
+        misang_sum = np.zeros(self.N)
+        nneighbors = np.zeros(self.N, dtype=int)
+        for d in shells:
+            j_shift, i_shift = self._get_shifts(d, True, distance_convention)
+            shell_sum, shell_nneighbors = self._sum_offset_misorientation(
+                j_shift, i_shift, sel, maxmis, **kwargs)
+
+            if perimeteronly:
+                misang_sum, nneighbors = shell_sum, shell_nneighbors
+            else:
+                misang_sum += shell_sum
+                nneighbors += shell_nneighbors
+
+            ok = nneighbors > 0  # invalid KAM when nneighbors is 0
+            for k in np.where(distances == d)[0]:
+                KAM[ok, k] = misang_sum[ok]/nneighbors[ok]
+
+        # Linear fit of KAM vs distance
+        slope = D*(KAM*distance).sum(axis=1) - KAM.sum(axis=1)*distance.sum()
+        slope /= D*(distance**2).sum() - (distance.sum())**2
+        intercept = (KAM.sum(axis=1) - slope*distance.sum())/D
+
+        KAMfit = slope.reshape(-1, 1)*distance + intercept.reshape(-1, 1)
+        SStot = ((KAM - KAM.mean(axis=1).reshape(-1, 1))**2).sum(axis=1)
+        SStot[SStot == 0.] = 1.
+        SSres = ((KAM - KAMfit)**2).sum(axis=1)
+        Rsquared = 1. - SSres/SStot
+
+        return KAM, distance, slope, intercept, Rsquared
+
+    def get_grains(self, threshold=5., min_size=1, sel=None, **kwargs):
+        """
+        Reconstructs the grains, i.e., the connected regions of pixels of
+        the same phase where the misorientation between first neighbors
+        is smaller than threshold
+
+        Parameters
+        ----------
+        threshold : float (optional)
+            Misorientation angle (in degrees) above which two neighboring
+            pixels are considered to belong to different grains
+            Default: 5.
+        min_size : int (optional)
+            Minimum number of pixels of a grain. Pixels of smaller grains
+            are not assigned to any grain
+            Default: 1
+        sel : bool numpy 1D array (optional)
+            Boolean array indicating data points calculations should be
+            performed. Pixels out of the selection are not assigned to
+            any grain
+            Default: None
+
+        **kwargs :
+            verbose : bool (optional)
+                If True, prints computation time
+                Default: True
+            kwargs parameters are also passed to misorientation_neighbors,
+            e.g., memory_limit and workers
+
+        Returns
+        -------
+        grains : int32 numpy ndarray shape(N)
+            Grain labels (0 to number of grains - 1). Pixels not assigned
+            to any grain are set to -1
+        """
+        from scipy.sparse import coo_matrix
+        from scipy.sparse.csgraph import connected_components
+
+        verbose = kwargs.pop('verbose', True)
+        if verbose:
+            t0 = time.time()
+            sys.stdout.write('Reconstructing grains... ')
+            sys.stdout.flush()
+
+        # Pairs of first neighbors belonging to the same grain. Only one
+        # half of the stencil is needed, since the graph is undirected
+        rows, cols = [], []
+        j_shift, i_shift = self._get_shifts(1)
+        for dj, di in zip(j_shift, i_shift):
+            if di < 0 or (di == 0 and dj < 0):
+                continue
+            misang, neighbors = self._offset_misorientation(dj, di, sel, **kwargs)
+            # misang is -1 for invalid neighbors and pixels out of sel
+            ok = (misang >= 0) & (misang < threshold)
+            ok[ok] = self.ph[ok] == self.ph[neighbors[ok]]
+            rows.append(self.index[ok].astype(np.int32))
+            cols.append(neighbors[ok].astype(np.int32))
+            del misang, neighbors, ok
+
+        rows, cols = np.hstack(rows), np.hstack(cols)
+        graph = coo_matrix((np.ones(len(rows), dtype=np.int8), (rows, cols)),
+                           shape=(self.N, self.N))
+        del rows, cols
+        _, labels = connected_components(graph, directed=False)
+        del graph
+
+        # Connected components with less than min_size pixels (including
+        # the isolated pixels out of the selection) are discarded and the
+        # remaining ones are relabeled sequentially
+        if sel is not None:
+            labels[~sel] = labels.max() + 1
+            size = np.bincount(labels)
+            size[-1] = 0
+        else:
+            size = np.bincount(labels)
+        keep = size >= max(1, min_size)
+        newlabels = np.full(len(size), -1, dtype=np.int32)
+        newlabels[keep] = np.arange(np.count_nonzero(keep), dtype=np.int32)
+        grains = newlabels[labels]
+
+        if verbose:
+            sys.stdout.write('{} grains found in {:.2f} s\n'.format(
+                np.count_nonzero(keep), time.time() - t0))
+            sys.stdout.flush()
+
+        return grains
+
+    def get_grain_stats(self, grains=None, threshold=5., min_size=1, sel=None, **kwargs):
+        """
+        Returns table with the statistics of every grain. All the
+        quantities are calculated for all grains at once, with a few
+        passes over the data
+
+        Parameters
+        ----------
+        grains : int numpy ndarray shape(N) (optional)
+            Grain labels (see get_grains). If None, the grains are
+            reconstructed by get_grains(threshold, min_size, sel)
+            Default: None
+        threshold : float (optional)
+            Misorientation angle (in degrees) used by get_grains
+            Default: 5.
+        min_size : int (optional)
+            Minimum number of pixels of a grain used by get_grains
+            Default: 1
+        sel : bool numpy 1D array (optional)
+            Boolean array indicating data points used by get_grains
+            Default: None
+
+        **kwargs :
+            kwargs parameters are passed to get_grains, e.g., verbose,
+            memory_limit and workers
+
+        Returns
+        -------
+        stats : pandas DataFrame
+            Statistics of the grains indexed by the grain labels, with the
+            columns (labels without any pixel are not listed):
+            ph : phase of the grain
+            size : number of pixels
+            area : area of the grain (size*dx*dy, in squared scan units)
+            x, y : coordinates of the centroid
+            phi1, Phi, phi2 : Euler angles (in radians) of the average
+                orientation, calculated by the eigenvector method after
+                reducing the orientations of the pixels to the same
+                fundamental zone
+            GOS : grain orientation spread, i.e., average misorientation
+                angle (in degrees) between the pixels and the average
+                orientation of the grain
+            GAM : grain average misorientation, i.e., average
+                misorientation angle (in degrees) between first neighbors
+                inside the grain. NaN for grains without neighbors
+            CI, IQ : average confidence index and image quality, if
+                available
+        """
+        if grains is None:
+            grains = self.get_grains(threshold, min_size, sel, **kwargs)
+        verbose = kwargs.pop('verbose', True)
+
+        if verbose:
+            t0 = time.time()
+            sys.stdout.write('Calculating grain statistics... ')
+            sys.stdout.flush()
+
+        ok = grains >= 0
+        labels = grains[ok]
+
+        # Labels with at least one pixel and first pixel of every grain.
+        # Labels without pixels (gaps in the labeling) are not listed
+        grain_labels, first = np.unique(labels, return_index=True)
+        first = self.index[ok][first]
+        ngrains = grain_labels[-1] + 1 if len(grain_labels) > 0 else 0
+
+        size = np.bincount(labels, minlength=ngrains)[grain_labels]
+
+        stats = pd.DataFrame(index=pd.Index(grain_labels, name='grain'))
+        stats['ph'] = self.ph[first]
+        stats['size'] = size
+        stats['area'] = size*self.dx*self.dy
+        stats['x'] = np.bincount(labels, weights=self.x[ok], minlength=ngrains)[grain_labels]/size
+        stats['y'] = np.bincount(labels, weights=self.y[ok], minlength=ngrains)[grain_labels]/size
+
+        # Average orientation. The orientations of the pixels are aligned
+        # to the first pixel of each grain and, on a second pass, to the
+        # average orientation
+        q = self.q
+        qref = np.zeros((ngrains, 4))
+        qref[:, 0] = 1.
+        qref[grain_labels] = q[first]
+        qavg = _average_quaternions_labels(q, grains, ngrains, qref)
+        qavg = _average_quaternions_labels(q, grains, ngrains, qavg)
+        # q describes M. Euler angles describe R = M^T
+        stats['phi1'], stats['Phi'], stats['phi2'] = quaternion_to_euler_angles(
+            _quaternion_conjugate(qavg[grain_labels]))
+
+        stats['GOS'] = _sum_misorientation_labels(q, grains, ngrains, qavg)[grain_labels]/size
+
+        # GAM: misorientations between first neighbors of the same grain.
+        # Each pair is accounted once (half of the stencil)
+        misang_sum = np.zeros(ngrains)
+        npairs = np.zeros(ngrains, dtype=int)
+        # Only the pairs of pixels assigned to grains are calculated
+        sel_grains = None if ok.all() else ok
+        j_shift, i_shift = self._get_shifts(1)
+        for dj, di in zip(j_shift, i_shift):
+            if di < 0 or (di == 0 and dj < 0):
+                continue
+            misang, neighbors = self._offset_misorientation(dj, di, sel_grains, **kwargs)
+            same = misang >= 0  # misang is -1 for invalid neighbors and pixels out of grains
+            same[same] = grains[same] == grains[neighbors[same]]
+            misang_sum += np.bincount(grains[same], weights=misang[same], minlength=ngrains)
+            npairs += np.bincount(grains[same], minlength=ngrains)
+            del neighbors, misang, same
+        # Grains without pairs of neighbors get NaN
+        GAM = np.full(len(grain_labels), np.nan)
+        npairs = npairs[grain_labels]
+        GAM[npairs > 0] = misang_sum[grain_labels][npairs > 0]/npairs[npairs > 0]
+        stats['GAM'] = GAM
+
+        for col in ['CI', 'IQ']:
+            if hasattr(self, col):
+                stats[col] = np.bincount(labels, weights=getattr(self, col)[ok],
+                                         minlength=ngrains)[grain_labels]/size
+
+        if verbose:
+            sys.stdout.write('{:.2f} s\n'.format(time.time() - t0))
+            sys.stdout.flush()
+
+        return stats
 
     def plot_IPF(self, d=[0, 0, 1], ax=None, sel=None, gray=None, graymin=0, graymax=None,
                  tiling=None, w=2048, scalebar=True, plotlimits=None, verbose=True, **kwargs):
@@ -435,7 +1071,7 @@ class ScanData(GridIndexing):
             else:
                 sel = sel & sellim
 
-        ebsdmap = plot_IPF(self.M, self.nrows, self.ncols_odd, self.ncols_even, self.x, self.y,
+        ebsdmap = plot_IPF(self.q, self.nrows, self.ncols_odd, self.ncols_even, self.x, self.y,
                            self.grid, self.dx, self.dy, d, ax, sel, gray, graymin, graymax,
                            tiling, w, scalebar, verbose, **kwargs)
         self.ebsdmaps.append(ebsdmap)
@@ -825,43 +1461,65 @@ class ScanData(GridIndexing):
 
     def save_ang_file(self, fname, sel=None, **kwargs):
         """
-        Export ScanData as ang file
+        Export ScanData as ang file. The data is formatted and written in
+        chunks, so the memory needed does not depend on the size of the
+        scan. If fname ends with '.gz', the file is gzip compressed
 
         Parameters
         ----------
         fname : str
             File name
         sel : list of array of booleans
-            selection
+            selection. Only the rectangle surrounding the selection is
+            exported, with the pixels out of the selection set as not
+            indexed (see selection_to_scandata)
+
+        **kwargs :
+            float_format : str
+                Format of the float columns
+                Default: '%.5f'
+            chunksize : int
+                Number of lines formatted at once
+                Default: 100000
         """
-        if sel is None:
-            newscan = self
-        else:
-            newscan = selection_to_scandata(self, sel)
+        float_format = kwargs.pop('float_format', '%.5f')
+        chunksize = kwargs.pop('chunksize', _ang_write_chunksize)
 
-        header = newscan.header
-        for i, line in enumerate(header):
-            if '# NCOLS_ODD:' in line:
-                header[i] = '# NCOLS_ODD: {:d}\n'.format(newscan.ncols_odd)
-                continue
-            if '# NCOLS_EVEN:' in line:
-                header[i] = '# NCOLS_EVEN: {:d}\n'.format(newscan.ncols_even)
-                continue
-            if '# NROWS:' in line:
-                header[i] = '# NROWS: {:d}\n'.format(newscan.nrows)
-                continue
+        # The rectangle surrounding the selection shares memory with self
+        # whenever possible (see selection_to_scandata)
+        scan = self if sel is None else selection_to_scandata(self, sel)
 
-        try:
+        # The header of the ScanData object is not modified
+        header = []
+        for line in self.header:
+            if '# NCOLS_ODD:' in line:
+                line = '# NCOLS_ODD: {:d}\n'.format(scan.ncols_odd)
+            elif '# NCOLS_EVEN:' in line:
+                line = '# NCOLS_EVEN: {:d}\n'.format(scan.ncols_even)
+            elif '# NROWS:' in line:
+                line = '# NROWS: {:d}\n'.format(scan.nrows)
+            header.append(line)
+
+        columns = list(self.data.columns)
+        # Same format used by DataFrame.to_csv(..., sep=' ', float_format=float_format)
+        fmt = ' '.join(['%d' if self.data[col].dtype.kind in 'iu' else float_format
+                        for col in columns]) + '\n'
+
+        if fname.endswith('.gz'):
+            file = gzip.open(fname, 'wt')
+        else:
             file = open(fname, 'w')
+
+        with file:
             file.write(''.join(header))
-            file.close()
-            newscan.data.to_csv(fname, mode='a',
-                                header=False, index=False, sep=' ',
-                                float_format=kwargs.pop('float_format', '%.5f'))
-        except:
-            raise
-        else:
-            print('scandata successfully saved as "{}"'.format(fname))
+            for start in range(0, scan.N, chunksize):
+                stop = min(start + chunksize, scan.N)
+                block = np.empty((stop - start, len(columns)), dtype=object)
+                for k, col in enumerate(columns):
+                    block[:, k] = scan.data[col].values[start:stop]
+                file.write((fmt*(stop - start)) % tuple(block.ravel()))
+
+        print('scandata successfully saved as "{}"'.format(fname))
 
     def clear_history(self):
         """
@@ -875,25 +1533,64 @@ class ScanData(GridIndexing):
         del self.axes[:]
 
 
+def _get_rectangle_surrounding_selection(scan, sel):
+    """
+    Select rectangle surrounding the selected data. The rectangle is
+    derived from the grid positions (i, j) of the selected pixels.
+
+    Returns
+    -------
+    ncols_odd, ncols_even, nrows : int
+        Dimensions of the rectangle
+    index : slice or int numpy 1D array
+        Indices of the pixels inside the rectangle. A slice is returned
+        when the pixels of the rectangle are contiguous in memory (e.g.,
+        when the rectangle spans the full width of the scan)
+    """
+    if scan.grid.lower() == 'hexgrid':
+        ncols_odd, ncols_even, nrows, starts, counts = _get_rectangle_surrounding_selection_hexgrid(scan, sel)
+    else:
+        ncols_odd, ncols_even, nrows, starts, counts = _get_rectangle_surrounding_selection_sqrgrid(scan, sel)
+
+    # total number of points
+    N = ncols_even*(nrows//2) + ncols_odd*(nrows - nrows//2)
+    if N != counts.sum():
+        raise Exception(('Something went wrong: expected number '
+                         'of points ({}) differs from what '
+                         'we got ({})').format(N, counts.sum()))
+
+    # Each row of the rectangle is a contiguous range of indices
+    if starts[-1] + counts[-1] - starts[0] == N:
+        index = slice(starts[0], starts[0] + N)
+    else:
+        offsets = np.cumsum(counts) - counts
+        index = np.repeat(starts - offsets, counts) + np.arange(N)
+
+    return ncols_odd, ncols_even, nrows, index
+
+
 def _get_rectangle_surrounding_selection_hexgrid(scan, sel):
     """
     Select rectangle surrounding the selected data.
     Some manipulations are necessary to ensure that
     ncols_odd = ncols_even + 1
+
+    Returns
+    -------
+    ncols_odd, ncols_even, nrows : int
+        Dimensions of the rectangle
+    starts, counts : int numpy 1D arrays
+        Index of the first pixel and number of pixels of each row
     """
-    # x
-    ind_xmin = scan.data.x[sel].idxmin()
-    ind_xmax = scan.data.x[sel].idxmax()
-    # y
-    ind_ymin = scan.data.y[sel].idxmin()
-    ind_ymax = scan.data.y[sel].idxmax()
+    isel = scan.i[sel]
+    jsel = scan.j[sel]
 
     # j
-    jmin = scan.j[ind_xmin]
-    jmax = scan.j[ind_xmax]
+    jmin = jsel.min()
+    jmax = jsel.max()
     # i
-    imin = scan.i[ind_ymin]
-    imax = scan.i[ind_ymax]
+    imin = isel.min()
+    imax = isel.max()
 
     if (jmin + imin) % 2 == 1:  # if jmin + imin is odd
         if jmin > 0:
@@ -908,74 +1605,65 @@ def _get_rectangle_surrounding_selection_hexgrid(scan, sel):
             imin -= 1  # add row to the top
             jmin -= 1  # add [another] columns to the left
 
-    xmin = scan.dx*(2.*jmin - 1.)/4.  # (jmin*dx/2 - dx/4)
-    xmax = scan.dx*(2.*jmax + 1.)/4.  # (jmax*dx/2 + dx/4)
-    ymin = scan.dy*(2.*imin - 1.)/2.  # (imin*dy - dy/2)
-    ymax = scan.dy*(2.*imax + 1.)/2.  # (imax*dy + dy/2)
-
     ncols_even = (jmax - jmin)//2
     ncols_odd = ncols_even + 1
     nrows = imax - imin + 1
 
-    # select rectangle surrounding the selected data
-    rect = (scan.x >= xmin) & (scan.x <= xmax) & \
-        (scan.y >= ymin) & (scan.y <= ymax)
-
-    # total number of points
-    N = ncols_even*(nrows//2) + ncols_odd*(nrows - nrows//2)
-    if N != np.count_nonzero(rect):
-        raise Exception(('Something went wrong: expected number '
-                         'of points ({}) differs from what '
-                         'we got ({})').format(N, np.count_nonzero(rect)))
+    # Rows alternate between ncols_odd pixels (starting at jmin) and
+    # ncols_even pixels (starting at jmin + 1)
+    shift = np.arange(nrows) % 2
+    starts = scan.ij_to_index(np.arange(imin, imax + 1), jmin + shift)
+    counts = ncols_odd - shift
 
-    return ncols_odd, ncols_even, nrows, rect
+    return ncols_odd, ncols_even, nrows, starts, counts
 
 
 def _get_rectangle_surrounding_selection_sqrgrid(scan, sel):
     """
     Select rectangle surrounding the selected data.
+
+    Returns
+    -------
+    ncols_odd, ncols_even, nrows : int
+        Dimensions of the rectangle
+    starts, counts : int numpy 1D arrays
+        Index of the first pixel and number of pixels of each row
     """
-    # x
-    ind_xmin = scan.data.x[sel].idxmin()
-    ind_xmax = scan.data.x[sel].idxmax()
-    # y
-    ind_ymin = scan.data.y[sel].idxmin()
-    ind_ymax = scan.data.y[sel].idxmax()
+    isel = scan.i[sel]
+    jsel = scan.j[sel]
 
     # j
-    jmin = scan.j[ind_xmin]
-    jmax = scan.j[ind_xmax]
+    jmin = jsel.min()
+    jmax = jsel.max()
     # i
-    imin = scan.i[ind_ymin]
-    imax = scan.i[ind_ymax]
-
-    xmin = scan.x[ind_xmin]
-    xmax = scan.x[ind_xmax]
-    ymin = scan.y[ind_ymin]
-    ymax = scan.y[ind_ymax]
+    imin = isel.min()
+    imax = isel.max()
 
     ncols_even = jmax - jmin + 1
     ncols_odd = ncols_even
     nrows = imax - imin + 1
 
-    # select rectangle surrounding the selected data
-    rect = (scan.x >= xmin) & (scan.x <= xmax) & \
-        (scan.y >= ymin) & (scan.y <= ymax)
+    starts = scan.ij_to_index(np.arange(imin, imax + 1), jmin)
+    counts = np.full(nrows, ncols_odd)
 
-    # total number of points
-    N = ncols_even*nrows
-    if N != np.count_nonzero(rect):
-        raise Exception(('Something went wrong: expected number '
-                         'of points ({}) differs from what '
-                         'we got ({})').format(N, np.count_nonzero(rect)))
-
-    return ncols_odd, ncols_even, nrows, rect
+    return ncols_odd, ncols_even, nrows, starts, counts
 
 
 def selection_to_scandata(scan, sel):
     """
     Convert selection to new ScanData object
 
+    Only the rectangle surrounding the selection is exported, and only the
+    rectangle is ever copied, never the whole scan. When the rectangle is
+    contiguous in memory (e.g., full width crops), the columns of the new
+    ScanData object are views of the columns of the original one, except
+    for x and y, which are always copied because they are shifted so that
+    the rectangle starts at (0, 0). Masking is eager: if the rectangle
+    contains pixels out of the selection, the columns with default values
+    for non-indexed pixels (phi1, Phi, phi2, IQ, CI, ph, intensity, fit)
+    are copied and the values of those pixels are set to default when
+    the new ScanData object is created.
+
     Parameters
     ----------
     scan : ScanData object
@@ -988,31 +1676,25 @@ def selection_to_scandata(scan, sel):
     newscan : ScanData object
 
     """
-
-    # copy of scan.data numpy array to be exported
-    newdata = scan.data.copy()  # raw data
-
-    # Regions not belonging to selection have values set to default
-    newdata.loc[~sel, 'phi1'] = 4.
-    newdata.loc[~sel, 'Phi'] = 4.
-    newdata.loc[~sel, 'phi2'] = 4.
-    newdata.loc[~sel, 'IQ'] = -1
-    newdata.loc[~sel, 'CI'] = -2
-    newdata.loc[~sel, 'ph'] = -1
-    newdata.loc[~sel, 'intensity'] = -1
-    newdata.loc[~sel, 'fit'] = 0
-
     # select rectangle surrounding the selected data
-    if scan.grid.lower() == 'hexgrid':
-        ncols_odd, ncols_even, nrows, rect = _get_rectangle_surrounding_selection_hexgrid(scan, sel)
-    else:
-        ncols_odd, ncols_even, nrows, rect = _get_rectangle_surrounding_selection_sqrgrid(scan, sel)
-
-    # data to be exported is a rectangle
-    newdata = newdata[rect]
-
-    # offset x and y so (xmin, ymin) becomes the origin (0, 0)
-    newdata.x -= newdata.x.min()
-    newdata.y -= newdata.y.min()
+    ncols_odd, ncols_even, nrows, index = _get_rectangle_surrounding_selection(scan, sel)
+
+    selrect = np.asarray(sel)[index]
+    masked = not selrect.all()
+
+    newdata = {}
+    for col in scan.data.columns:
+        # view if index is a slice
+        values = scan.data[col].values[index]
+        if col in ('x', 'y'):
+            # offset x and y so (xmin, ymin) becomes the origin (0, 0).
+            # New array, so the original scan is never modified
+            values = values - values.min()
+        elif masked and col in _unselected_values:
+            # Regions not belonging to selection have values set to default
+            values = np.where(selrect, values, np.asarray(_unselected_values[col], dtype=values.dtype))
+        newdata[col] = values
+
+    newdata = pd.DataFrame(newdata, columns=scan.data.columns, copy=False)
 
     return ScanData(newdata, scan.grid, scan.dx, scan.dy, ncols_odd, ncols_even, nrows, scan.header)
@@ -1,11 +1,47 @@
 import os
+import glob
+import json
+import importlib
 import time
+import shutil
+import warnings
 import numpy as np
 import pandas as pd
 
 from ..ebsd import ScanData
 
-__all__ = ['load_ang_file', 'load_scandata']
+__all__ = ['load_ang_file', 'iter_ang_chunks', 'load_osc_file', 'load_scandata',
+           'load_many']
+
+
+# Modules used to decompress files on the fly, by extension
+_COMPRESSION_MODULES = {'.gz': 'gzip',
+                        '.bz2': 'bz2',
+                        '.xz': 'lzma'}
+
+
+def _split_compression_ext(fname):
+    """
+    Returns the extension of the file format (e.g., '.ang') and the
+    extension of the compression ('.gz', '.bz2', '.xz', or '' if the file
+    is not compressed)
+    """
+    root, ext = os.path.splitext(fname)
+    if ext.lower() in _COMPRESSION_MODULES:
+        return os.path.splitext(root)[-1], ext.lower()
+    return ext, ''
+
+
+def _open_text(fname):
+    """
+    Opens fname in text mode. gzip, bz2, and xz compressed files are
+    decompressed on the fly while they are read
+    """
+    compression = _split_compression_ext(fname)[-1]
+    if compression:
+        module = importlib.import_module(_COMPRESSION_MODULES[compression])
+        return module.open(fname, 'rt')
+    return open(fname)
 
 
 def _parse_info_header(line, pattern, dtype=str):
@@ -14,7 +50,235 @@ def _parse_info_header(line, pattern, dtype=str):
     return info
 
 
-def load_ang_file(fname):
+# Patterns of the header lines providing info about the scan, the name of
+# the corresponding arguments of ScanData and their types
+_ANG_HEADER_INFO = [('# GRID:', 'grid', str),
+                    ('# XSTEP:', 'dx', float),
+                    ('# YSTEP:', 'dy', float),
+                    ('# NCOLS_ODD:', 'ncols_odd', int),
+                    ('# NCOLS_EVEN:', 'ncols_even', int),
+                    ('# NROWS:', 'nrows', int)]
+
+# Names of the first columns of the body of ang files
+_ANG_COLUMNS = ['phi1', 'Phi', 'phi2', 'x', 'y', 'IQ', 'CI', 'ph', 'intensity', 'fit']
+
+# Number of rows parsed at once when reading the body of ang files
+_ANG_CHUNKSIZE = 100000
+
+
+def _read_ang_header(f):
+    """
+    Reads the header of an ang file from the file object f
+
+    Returns
+    -------
+    header : list of strings
+        Lines of the header
+    info : dict
+        Scan info parsed from the header (grid, dx, dy, ncols_odd,
+        ncols_even, nrows)
+    line : string
+        First line of the body. After calling _read_ang_header, the
+        position of f is at the beginning of the second line of the body
+    """
+    header = []
+    info = {}
+    line = ''
+    for line in f:
+        # If header
+        if line[0] == '#' or line[0] == '\n':
+            header.append(line)
+            for pattern, key, dtype in _ANG_HEADER_INFO:
+                if pattern in line:
+                    info[key] = _parse_info_header(line, pattern, dtype)
+                    break
+        else:
+            break
+    else:
+        line = ''  # file has no body
+
+    if len(info) != len(_ANG_HEADER_INFO):
+        raise Exception('Info about scandata is missing in the file header.')
+
+    return header, info, line
+
+
+def _number_of_points(grid, ncols_odd, ncols_even, nrows):
+    """
+    Number of points of the scan according to the grid description
+    (see GridIndexing)
+    """
+    if grid.lower() == 'hexgrid':
+        return ncols_even*(nrows//2) + ncols_odd*(nrows - nrows//2)
+    return ncols_odd*nrows
+
+
+def _ang_column_names(ncols):
+    """
+    Names of the columns of the body of ang files. Extra columns (e.g.,
+    EDS counts) are named by their indices, as pandas does
+    """
+    return _ANG_COLUMNS[:ncols] + list(range(len(_ANG_COLUMNS), ncols))
+
+
+def _select_columns(names, columns=None):
+    """
+    Indices of the columns 'columns' in the list of column names 'names'.
+    The columns required by ScanData (phi1, Phi, phi2, x, y, and ph) are
+    always selected. If columns is None, all columns are selected
+    """
+    names = list(names)
+    if columns is None:
+        return list(range(len(names)))
+
+    columns = list(columns)
+    for col in columns:
+        if col not in names:
+            raise Exception('Column "{}" not found in the file'.format(col))
+
+    return [k for k, col in enumerate(names)
+            if col in columns or col in ScanData.required_columns]
+
+
+def _is_int_token(token):
+    try:
+        int(token)
+    except ValueError:
+        return False
+    return True
+
+
+def _ang_body_columns(line, columns=None):
+    """
+    Parses the first line of the body of an ang file and selects the
+    columns 'columns' (plus the columns required by ScanData)
+
+    Returns
+    -------
+    usecols : list of int
+        Indices of the selected columns
+    names : list
+        Names of the selected columns
+    first : numpy ndarray
+        Values of the selected columns in the first line
+    intcols : list of bool
+        True for the selected columns whose values in the first line are
+        written as integers
+    """
+    tokens = line.split()
+    usecols = _select_columns(_ang_column_names(len(tokens)), columns)
+    names = [_ang_column_names(len(tokens))[k] for k in usecols]
+    first = np.array([float(tokens[k]) for k in usecols])
+    intcols = [_is_int_token(tokens[k]) for k in usecols]
+    return usecols, names, first, intcols
+
+
+def _read_ang_rows(f, n, usecols, first=None):
+    """
+    Reads (at most) n lines of the body of an ang file from the file
+    object f. If first is provided, it is used as the first line.
+    Returns 2D numpy ndarray with the columns usecols
+    """
+    if first is not None:
+        n -= 1
+    chunk = np.empty((0, len(usecols)))
+    if n > 0:
+        with warnings.catch_warnings():
+            # np.loadtxt warns when the end of the file is reached
+            warnings.simplefilter('ignore', UserWarning)
+            chunk = np.loadtxt(f, usecols=usecols, max_rows=n, ndmin=2)
+        if chunk.size == 0:
+            chunk = np.empty((0, len(usecols)))
+    if first is not None:
+        chunk = np.vstack([first.reshape(1, -1), chunk])
+    return chunk
+
+
+def _to_int_columns(data, intcols):
+    """
+    Converts to int the columns of data (list of 1D arrays) flagged by
+    intcols if all their values are integers
+    """
+    for k, isint in enumerate(intcols):
+        if isint and np.all(np.mod(data[k], 1.) == 0.):
+            data[k] = data[k].astype(int)
+    return data
+
+
+def _read_ang_body(f, line, N, columns=None, chunksize=_ANG_CHUNKSIZE):
+    """
+    Reads the body of an ang file from the file object f, whose position
+    is right after the first line of the body 'line'. Only the columns
+    listed in 'columns' (plus the columns required by ScanData) are kept.
+    Columns are preallocated with N rows and filled in chunks of
+    chunksize rows
+
+    Returns
+    -------
+    names : list
+        Names of the columns read
+    data : list of numpy ndarray shape(N)
+        Columns of the body of the ang file. Columns whose values are all
+        written as integers are converted to int
+    """
+    usecols, names, first, intcols = _ang_body_columns(line, columns)
+    data = [np.empty(N, dtype=float) for _ in usecols]
+
+    n = 0
+    while n < N:
+        chunk = _read_ang_rows(f, min(chunksize, N - n), usecols,
+                               first if n == 0 else None)
+        if len(chunk) == 0:
+            break
+        for k, col in enumerate(data):
+            col[n:n + len(chunk)] = chunk[:, k]
+        n += len(chunk)
+
+    # Remaining lines must not contain data
+    for line in f:
+        if line.strip() and line.lstrip()[0] != '#':
+            raise Exception(('Number of points in the file exceeds the expected '
+                             'value ({})').format(N))
+
+    if n < N:
+        # ScanData raises exception for the mismatching number of points
+        data = [col[:n] for col in data]
+
+    return names, _to_int_columns(data, intcols)
+
+
+def _read_ang_file(fname, columns=None):
+    """
+    Reads a TSL ang file. See load_ang_file
+
+    Returns
+    -------
+    header : list of strings
+        Lines of the header
+    info : dict
+        Scan info parsed from the header (grid, dx, dy, ncols_odd,
+        ncols_even, nrows)
+    data : pandas DataFrame
+        Body of the ang file
+    """
+    t0 = time.time()
+    print('Reading file \"{}\"...'.format(fname))
+
+    # Header and body are read in a single pass
+    with _open_text(fname) as f:
+        header, info, line = _read_ang_header(f)
+        N = _number_of_points(info['grid'], info['ncols_odd'],
+                              info['ncols_even'], info['nrows'])
+        names, data = _read_ang_body(f, line, N, columns)
+
+    data = pd.DataFrame(dict(zip(names, data)), columns=names, copy=False)
+
+    print('\n{} points read in {:.2f} s'.format(len(data), time.time() - t0))
+
+    return header, info, data
+
+
+def load_ang_file(fname, columns=None):
     """
     Loads a TSL ang file. 
     The fields of each line in the body of the TSL ang file are as follows:
@@ -49,94 +313,560 @@ def load_ang_file(fname):
     Parameters
     ----------
     fname : string
-        Path to the ang file
+        Path to the ang file. Files compressed with gzip, bz2, or xz
+        (e.g., 'scan.ang.gz') are decompressed on the fly
+    columns : list (optional)
+        Names of the columns to be loaded, e.g., ['IQ', 'CI']. The columns
+        phi1, Phi, phi2, x, y, and ph are always loaded. Extra columns are
+        named by their indices (10, 11, ...). If None, all columns are
+        loaded
+        Default: None
+
+    Returns
+    -------
+    scan : ScanData object
+
+    """
+    header, info, data = _read_ang_file(fname, columns)
+    return ScanData(data, info['grid'], info['dx'], info['dy'], info['ncols_odd'],
+                    info['ncols_even'], info['nrows'], header)
+
+
+def iter_ang_chunks(fname, rows_per_chunk=100, columns=None):
+    """
+    Generator that reads a TSL ang file in blocks of complete rows of the
+    scan grid, without ever loading the whole file in memory. Useful for
+    computing statistics (e.g., phase fractions, CI histograms) of files
+    that do not fit in memory.
+
+    Parameters
+    ----------
+    fname : string
+        Path to the ang file, optionally compressed with gzip, bz2, or xz
+    rows_per_chunk : int (optional)
+        Number of rows of the scan grid in each block
+        Default: 100
+    columns : list (optional)
+        Names of the columns to be read (see load_ang_file). If None, all
+        columns are read
+        Default: None
+
+    Yields
+    ------
+    irows : numpy ndarray
+        Indices (0 -> nrows - 1) of the rows of the scan grid in the block
+    data : pandas DataFrame
+        Data of the points in the block, ordered row by row as in the file
+    """
+    with _open_text(fname) as f:
+        header, info, line = _read_ang_header(f)
+        if not line:
+            return
+
+        usecols, names, first, intcols = _ang_body_columns(line, columns)
+
+        nrows = info['nrows']
+        if info['grid'].lower() == 'hexgrid':
+            npoints = np.array([info['ncols_odd'], info['ncols_even']])[np.arange(nrows) % 2]
+        else:
+            npoints = np.full(nrows, info['ncols_odd'])
+
+        for r0 in range(0, nrows, rows_per_chunk):
+            irows = np.arange(r0, min(r0 + rows_per_chunk, nrows))
+            chunk = _read_ang_rows(f, npoints[irows].sum(), usecols,
+                                   first if r0 == 0 else None)
+            if len(chunk) == 0:
+                break
+            data = _to_int_columns([chunk[:, k] for k in range(len(usecols))], intcols)
+            yield irows, pd.DataFrame(dict(zip(names, data)), columns=names, copy=False)
+
+
+# Sequence of bytes preceding the data block of osc files
+_OSC_DATA_MARKER = b'\xb9\x0b\xef\xff\x02\x00\x00\x00'
+
+# Default number of fields (float32) of each point in osc files
+_OSC_NFIELDS = 10
+
+
+def _find_osc_data_marker(f, buffersize=2**20):
+    """
+    Position in the binary file object f of the sequence of bytes
+    _OSC_DATA_MARKER
+    """
+    f.seek(0)
+    pos = 0
+    tail = b''
+    while True:
+        buff = f.read(buffersize)
+        if not buff:
+            raise Exception('Data block not found in the osc file')
+        buff = tail + buff
+        k = buff.find(_OSC_DATA_MARKER)
+        if k >= 0:
+            return pos + k
+        # keeps the end of the buffer, in case the marker is split between buffers
+        tail = buff[-(len(_OSC_DATA_MARKER) - 1):]
+        pos += len(buff) - len(tail)
+
+
+def _osc_grid_info(x, y, dx, dy):
+    """
+    Grid type and number of rows and columns of the scan derived from the
+    pixel coordinates x, y
+    """
+    i = np.round((y - y.min())/dy).astype(int)
+    npoints = np.bincount(i)  # number of points in each row
+    nrows = len(npoints)
+    ncols_odd = int(npoints[0])
+    ncols_even = int(npoints[1]) if nrows > 1 else ncols_odd
+
+    grid = 'SqrGrid'
+    if nrows > 1:
+        # In hexagonal grids, even rows are shifted by dx/2 with respect to odd rows
+        shift = x[ncols_odd] - x[0]
+        if abs(abs(shift) - .5*dx) < .25*dx:
+            grid = 'HexGrid'
+
+    return dict(grid=grid, dx=dx, dy=dy, ncols_odd=ncols_odd,
+                ncols_even=ncols_even, nrows=nrows)
+
+
+def _read_osc_file(fname, columns=None):
+    """
+    Reads a TSL osc file. See load_osc_file
+
+    Returns
+    -------
+    header : list of strings
+        Header in the format of ang files generated from the info about
+        the scan
+    info : dict
+        Scan info (grid, dx, dy, ncols_odd, ncols_even, nrows)
+    data : pandas DataFrame
+        Data of the osc file, with the same columns as ang files
+    """
+    t0 = time.time()
+    print('Reading file \"{}\"...'.format(fname))
+
+    with open(fname, 'rb') as f:
+        # The 7th 32-bit word of the file header is the number of points
+        N = int(np.fromfile(f, dtype='<u4', count=8)[6])
+
+        f.seek(_find_osc_data_marker(f) + len(_OSC_DATA_MARKER))
+        word = np.fromfile(f, dtype='<u4', count=1)
+
+        # In some versions of the format, the marker is followed by the size,
+        # in bytes, of the data block (2 step sizes + N*nfields values)
+        nfields = _OSC_NFIELDS
+        nvalues = int(word[0])//4 - 2
+        if N > 0 and nvalues % N == 0 and _OSC_NFIELDS <= nvalues//N <= 10*_OSC_NFIELDS:
+            nfields = nvalues//N
+            dx, dy = np.fromfile(f, dtype='<f4', count=2).astype(float)
+        else:
+            dx = float(word.view('<f4')[0])
+            dy = float(np.fromfile(f, dtype='<f4', count=1)[0])
+
+        records = np.fromfile(f, dtype='<f4', count=N*nfields)
+
+    # shortest decimal representation of the float32 step sizes (e.g., 0.1)
+    dx, dy = float(str(np.float32(dx))), float(str(np.float32(dy)))
+
+    if len(records) != N*nfields:
+        raise Exception('Data block of the osc file is incomplete')
+
+    records = records.reshape(N, nfields)
+    names = _ang_column_names(nfields)
+    info = _osc_grid_info(records[:, 3], records[:, 4], dx, dy)
+
+    for pattern, key, dtype in _ANG_HEADER_INFO:
+        print('{} {}'.format(pattern, info[key]))
+
+    header = ['{} {}\n'.format(pattern, info[key]) for pattern, key, dtype in _ANG_HEADER_INFO]
+    header.append('#\n')
+
+    usecols = _select_columns(names, columns)
+    data = [records[:, k].astype(float) for k in usecols]
+    # ph and intensity are integers, as in ang files
+    intcols = [names[k] in ('ph', 'intensity') for k in usecols]
+    names = [names[k] for k in usecols]
+    data = pd.DataFrame(dict(zip(names, _to_int_columns(data, intcols))),
+                        columns=names, copy=False)
+
+    print('\n{} points read in {:.2f} s'.format(len(data), time.time() - t0))
+
+    return header, info, data
+
+
+def load_osc_file(fname, columns=None):
+    """
+    Loads a TSL osc file, i.e., the binary counterpart of the ang file.
+    The data block is read directly with numpy.fromfile. Each point
+    has the same fields (float32) as the lines of the ang files:
+
+        phi1 Phi phi2 x y IQ CI ph intensity fit
+
+    The grid type and the number of rows and columns are derived from
+    the pixel coordinates. The phase information stored in the header of
+    the osc file is not parsed.
+
+    Parameters
+    ----------
+    fname : string
+        Path to the osc file
+    columns : list (optional)
+        Names of the columns to be loaded (see load_ang_file). If None, all
+        columns are loaded
+        Default: None
 
     Returns
     -------
     scan : ScanData object
 
+    """
+    header, info, data = _read_osc_file(fname, columns)
+    return ScanData(data, info['grid'], info['dx'], info['dy'], info['ncols_odd'],
+                    info['ncols_even'], info['nrows'], header)
+
+
+# Functions used by load_scandata to read each file format. They return
+# header, info, and data (see _read_ang_file)
+_readers = {'.ang': _read_ang_file,
+            '.osc': _read_osc_file}
+
+# File formats that can be read from compressed files
+_compressible = ['.ang']
+
+
+def _supported_file(fname):
+    """
+    True if fname can be read by load_scandata
+    """
+    ext, compression = _split_compression_ext(fname)
+    return ext in _readers and (not compression or ext in _compressible)
+
+
+_SIDECAR_VERSION = 1
+_SIDECAR_EXT = '.pyebsd'
+_SIDECAR_INFO = 'info.json'
+
+
+def _sidecar_dirname(fname):
+    """
+    Path to the directory where the binary sidecar of fname is stored
+    """
+    return fname + _SIDECAR_EXT
+
+
+def _source_signature(fname):
+    """
+    Size and modification time of the source file, used to check if the
+    sidecar is still up to date
+    """
+    stat = os.stat(fname)
+    return stat.st_size, stat.st_mtime
+
+
+def _save_sidecar(fname, header, info, data):
+    """
+    Saves the columns of data as .npy files (one file per column) and the
+    header information as json in the sidecar directory of fname
+    """
+    dirname = _sidecar_dirname(fname)
+    if os.path.isdir(dirname):
+        shutil.rmtree(dirname)
+    os.mkdir(dirname)
+
+    columns = []
+    for k, col in enumerate(data.columns):
+        colfname = 'col_{:d}.npy'.format(k)
+        np.save(os.path.join(dirname, colfname), data[col].values)
+        # numpy integers are not json serializable
+        columns.append([col if isinstance(col, str) else int(col), colfname])
+
+    _save_sidecar_info(fname, header, info, columns)
+
+
+def _stream_ang_sidecar(fname, rows_per_chunk=1000):
+    """
+    Builds the sidecar of the ang file fname by streaming the body with
+    iter_ang_chunks directly into memory-mapped .npy files, so the whole
+    file is never loaded in memory
     """
     t0 = time.time()
     print('Reading file \"{}\"...'.format(fname))
 
-    # Read and parse header
-    with open(fname) as f:
-        header = []
-        nmatches = 0
-        for line in f:
-            # If header
-            if line[0] == '#' or line[0] == '\n':
-                header.append(line)
+    with _open_text(fname) as f:
+        header, info, _ = _read_ang_header(f)
+    N = _number_of_points(info['grid'], info['ncols_odd'], info['ncols_even'], info['nrows'])
 
-                pattern = '# GRID:'
-                if pattern in line:
-                    grid = _parse_info_header(line, pattern)
-                    nmatches += 1
-                    continue
-                pattern = '# XSTEP:'
-                if pattern in line:
-                    dx = _parse_info_header(line, pattern, float)
-                    nmatches += 1
-                    continue
-                pattern = '# YSTEP:'
-                if pattern in line:
-                    dy = _parse_info_header(line, pattern, float)
-                    nmatches += 1
-                    continue
-                pattern = '# NCOLS_ODD:'
-                if pattern in line:
-                    ncols_odd = _parse_info_header(line, pattern, int)
-                    nmatches += 1
-                    continue
-                pattern = '# NCOLS_EVEN:'
-                if pattern in line:
-                    ncols_even = _parse_info_header(line, pattern, int)
-                    nmatches += 1
-                    continue
-                pattern = '# NROWS:'
-                if pattern in line:
-                    nrows = _parse_info_header(line, pattern, int)
-                    nmatches += 1
-                    continue
-            else:
-                break
+    dirname = _sidecar_dirname(fname)
+    if os.path.isdir(dirname):
+        shutil.rmtree(dirname)
+    os.mkdir(dirname)
 
-    if nmatches != 6:
-        raise Exception('Info about scandata is missing in the file header.')
+    columns, arrays = [], []
+    n = 0
+    for irows, chunk in iter_ang_chunks(fname, rows_per_chunk):
+        if not arrays:
+            for k, col in enumerate(chunk.columns):
+                colfname = 'col_{:d}.npy'.format(k)
+                arrays.append(np.lib.format.open_memmap(os.path.join(dirname, colfname), mode='w+',
+                                                        dtype=chunk[col].dtype, shape=(N,)))
+                # numpy integers are not json serializable
+                columns.append([col if isinstance(col, str) else int(col), colfname])
+        for arr, col in zip(arrays, chunk.columns):
+            arr[n:n + len(chunk)] = chunk[col].values
+        n += len(chunk)
+    for arr in arrays:
+        arr.flush()
+    del arrays
+
+    if n != N:
+        shutil.rmtree(dirname)
+        raise Exception(('Number of points in the file ({}) does not match the expected '
+                         'value ({})').format(n, N))
+
+    _save_sidecar_info(fname, header, info, columns)
+
+    print('\n{} points read in {:.2f} s'.format(n, time.time() - t0))
+
+
+def _save_sidecar_info(fname, header, info, columns):
+    """
+    Writes the json file with the header information and the list of
+    columns of the sidecar of fname
+    """
+    dirname = _sidecar_dirname(fname)
+    size, mtime = _source_signature(fname)
+    info = dict(info, version=_SIDECAR_VERSION, source_size=size, source_mtime=mtime,
+                header=list(header), columns=columns)
+
+    # info.json is written last, so an incomplete sidecar is never considered valid
+    with open(os.path.join(dirname, _SIDECAR_INFO), 'w') as f:
+        json.dump(info, f)
+
+
+def _read_sidecar_info(fname):
+    """
+    Returns the info dictionary of the sidecar of fname if the sidecar exists
+    and matches the size and the modification time of fname. Otherwise,
+    returns None
+    """
+    infofname = os.path.join(_sidecar_dirname(fname), _SIDECAR_INFO)
+    try:
+        with open(infofname) as f:
+            info = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+    size, mtime = _source_signature(fname)
+    if (info.get('version') != _SIDECAR_VERSION or info['source_size'] != size or
+            info['source_mtime'] != mtime):
+        return None
+
+    return info
+
+
+def _load_sidecar(fname, info, columns=None, mmap_mode=None):
+    """
+    Loads the columns 'columns' (see load_ang_file) from the sidecar of
+    fname. If mmap_mode is provided (see numpy.load), the columns are
+    memory-mapped. Returns header, info, and data as _read_ang_file
+    """
+    t0 = time.time()
+    dirname = _sidecar_dirname(fname)
+    print('Reading cached file \"{}\"...'.format(dirname))
 
-    # Uses pandas to read ang file. pd.read_csv returns a pandas DataFrame
-    data = pd.read_csv(fname, header=None, comment='#',
-                       delim_whitespace=True)
-    # Rename the columns
-    columns = list(data.columns)
-    columns[:10] = ['phi1', 'Phi', 'phi2', 'x',
-                    'y', 'IQ', 'CI', 'ph', 'intensity', 'fit']
-    data.columns = columns
+    names = [col for col, _ in info['columns']]
+    usecols = [info['columns'][k] for k in _select_columns(names, columns)]
+    data = pd.DataFrame({col: np.load(os.path.join(dirname, colfname), mmap_mode=mmap_mode)
+                         for col, colfname in usecols},
+                        columns=[col for col, _ in usecols], copy=False)
 
     print('\n{} points read in {:.2f} s'.format(len(data), time.time() - t0))
 
-    return ScanData(data, grid, dx, dy, ncols_odd, ncols_even, nrows, header)
+    return info['header'], info, data
 
 
-def load_scandata(fname):
+def load_scandata(fname, columns=None, cache=False, rebuild_cache=False, mmap=False):
     """
     Load EBSD scan data
 
     Parameters
     ----------
     fname : string
-        Path to the file to be loaded
+        Path to the file to be loaded. ang files compressed with gzip, bz2,
+        or xz (e.g., 'scan.ang.gz') are decompressed on the fly, without
+        temporary files
+    columns : list (optional)
+        Names of the columns to be loaded, e.g., ['IQ', 'CI']. The columns
+        phi1, Phi, phi2, x, y, and ph are always loaded. If None, all
+        columns are loaded
+        Default: None
+    cache : bool (optional)
+        If True, the parsed data is stored in a binary sidecar directory
+        (fname + '.pyebsd') the first time the file is loaded. In the
+        subsequent calls, the data is read from the sidecar as long as
+        the size and the modification time of the file do not change.
+        The sidecar always stores all the columns of the file
+        Default: False
+    rebuild_cache : bool (optional)
+        If True, the file is parsed again and the sidecar is rebuilt
+        Default: False
+    mmap : bool (optional)
+        If True, the columns are memory-mapped from the sidecar instead
+        of being loaded in memory, and arrays derived from them (e.g.,
+        ScanData.R) are stored as memory-mapped files in the sidecar
+        directory. This allows working with scans larger than the
+        available memory. When the sidecar is built, ang files are
+        streamed into it block by block; osc files are parsed in memory
+        once. mmap=True implies cache=True
+        Default: False
 
     Returns
     -------
     scan : ScanData object
 
     """
-    ext = os.path.splitext(fname)[-1]
+    ext, compression = _split_compression_ext(fname)
 
-    if ext == '.ang':
-        scan = load_ang_file(fname)
+    try:
+        _read = _readers[ext]
+    except KeyError:
+        raise Exception('File extension "{}" not supported'.format(ext + compression))
+
+    if compression and ext not in _compressible:
+        raise Exception('Compressed "{}" files not supported'.format(ext))
+
+    if mmap:
+        cache = True
+
+    info = None
+    if cache and not rebuild_cache:
+        info = _read_sidecar_info(fname)
+
+    if mmap:
+        if info is None:
+            if ext == '.ang':
+                # Streamed, so the file does not need to fit in memory
+                _stream_ang_sidecar(fname)
+            else:
+                header, info, data = _read(fname)
+                _save_sidecar(fname, header, info, data)
+                del data
+            info = _read_sidecar_info(fname)
+        # Copy-on-write: changes to the arrays are not written to the sidecar
+        header, info, data = _load_sidecar(fname, info, columns, mmap_mode='c')
+        return ScanData(data, info['grid'], info['dx'], info['dy'], info['ncols_odd'],
+                        info['ncols_even'], info['nrows'], header,
+                        mmap_dir=_sidecar_dirname(fname))
+
+    if info is not None:
+        header, info, data = _load_sidecar(fname, info, columns)
+    elif cache:
+        # All columns are read, so the sidecar can be reused regardless of 'columns'
+        header, info, data = _read(fname)
+        try:
+            _save_sidecar(fname, header, info, data)
+        except (IOError, OSError) as ex:
+            print('Could not write cache for "{}": {}'.format(fname, ex))
+        if columns is not None:
+            names = [data.columns[k] for k in _select_columns(data.columns, columns)]
+            data = pd.DataFrame({col: data[col].values for col in names},
+                                columns=names, copy=False)
     else:
-        raise Exception('File extension "{}" not supported'.format(ext))
+        header, info, data = _read(fname, columns)
+
+    return ScanData(data, info['grid'], info['dx'], info['dy'], info['ncols_odd'],
+                    info['ncols_even'], info['nrows'], header)
+
+
+def _load_scandata_worker(args):
+    k, fname, kwargs = args
+    return k, fname, load_scandata(fname, **kwargs)
+
+
+def _iter_load_many(fnames, workers, max_pending, kwargs):
+    """
+    Generator that loads the files fnames in a process pool, keeping at
+    most max_pending files submitted and not yet yielded. Yields
+    (k, fname, scan) in completion order, k being the index of fname
+    """
+    if workers == 1:
+        for k, fname in enumerate(fnames):
+            yield _load_scandata_worker((k, fname, kwargs))
+        return
+
+    from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+    with ProcessPoolExecutor(workers) as pool:
+        pending = set()
+        for k, fname in enumerate(fnames):
+            if len(pending) >= max_pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+            pending.add(pool.submit(_load_scandata_worker, (k, fname, kwargs)))
+
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+
+def load_many(paths, workers=None, max_pending=None, ordered=True, **kwargs):
+    """
+    Load several EBSD scans in parallel using a pool of processes
+
+    Parameters
+    ----------
+    paths : string or list of strings
+        List of paths to the files to be loaded. If a directory is provided,
+        all the files in it with supported extensions are loaded
+    workers : int (optional)
+        Number of worker processes. If None, the number of CPUs is used
+        Default: None
+    max_pending : int (optional)
+        Maximum number of scans being decoded or waiting to be collected at
+        the same time. If None, 2*workers is used. The bound only limits
+        the memory used by the loader when ordered=False and the scans
+        are consumed as they are yielded; with ordered=True, all the
+        scans are kept in the returned list, so the memory needed grows
+        with the number of files regardless of max_pending
+        Default: None
+    ordered : bool (optional)
+        If True, returns a list of ScanData objects in the same order as
+        paths. If False, returns a generator yielding (fname, scan) tuples
+        in the order the files finish loading
+        Default: True
+    **kwargs :
+        kwargs parameters are passed to load_scandata (e.g., columns, cache)
+
+    Returns
+    -------
+    scans : list of ScanData objects or generator of (fname, ScanData)
+        tuples
+    """
+    if isinstance(paths, str):
+        if os.path.isdir(paths):
+            paths = sorted([fname for fname in glob.glob(os.path.join(paths, '*'))
+                            if _supported_file(fname)])
+        else:
+            paths = [paths]
+    paths = list(paths)
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, len(paths)))
+    if max_pending is None:
+        max_pending = 2*workers
+    max_pending = max(1, max_pending)
+
+    scans = _iter_load_many(paths, workers, max_pending, kwargs)
+    if not ordered:
+        return ((fname, scan) for k, fname, scan in scans)
 
-    return scan
+    ordered_scans = [None]*len(paths)
+    for k, fname, scan in scans:
+        ordered_scans[k] = scan
+    return ordered_scans
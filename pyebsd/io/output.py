@@ -5,7 +5,8 @@ __all__ = ['save_ang_file']
 
 def save_ang_file(fname, scan, sel=None, **kwargs):
     """
-    Export ScanData object scan as ang file
+    Export ScanData object scan as ang file. If fname ends with '.gz',
+    the file is gzip compressed
 
     Arguments
     ---------
@@ -10,6 +10,7 @@ setup(
     packages=['pyebsd', 'pyebsd.ebsd', 'pyebsd.io',
               'pyebsd.selection', 'pyebsd.draw', 'pyebsd.misc'],
     include_package_data=True,
+    python_requires='>=3.5',
     install_requires=['numpy', 'matplotlib', 'pandas',
                       'scipy', 'pillow'],
     long_description=open('README.md').read()